@@ -1,73 +1,170 @@
+import numpy as np
 import pandas as pd
-import umap
-from sklearn.neighbors import LocalOutlierFactor
 from sklearn.preprocessing import StandardScaler
 from sklearn.decomposition import PCA
-import tensorflow_hub as hub
-from app.database import db_get_faq_feedback, db_get_message_analytics
+from app.datasets import has_dataset, save_dataset
+from app.metrics import span, timed
+from app.embedding import embed, USE_MODEL_URL
+from app.neighbors import make_lof, partitioned_lof, LOF_BACKEND, OUTLIER_PARTITION
+from app.centroids import score_by_market
+from app.novelty import get_novelty_model, NOVELTY_METHOD
+from app.reduction import LARGE_DATA_ROWS, fit_scaler, fit_umap, fit_incremental_pca, transform_chunks, \
+    load_reducer, save_reducer, bot_name
+from app.rollups import aggregate_feedback, market_summary, confidence_by_period
+from app.uploads import read_upload
 
-pos_feedback, neg_feedback = db_get_faq_feedback()
-something_else_triggers = db_get_message_analytics(something_else=True)
-all_messages = db_get_message_analytics(something_else=False)
 
+def _no_progress(fraction, message=''):
+    print(message)
 
-def load_data(df_vec, df_meta):
+
+def load_data(df_vec, df_meta, progress=_no_progress, bot=None):
     """
-    :param df_vec: dataframe of vector embeddings of text
+    Large uploads are scaled in chunks and UMAP is fit on a sample, the remaining rows are projected with transform.
+    If a reducer was saved for the bot it is reused, so the upload is projected without refitting.
+    :param df_vec: matrix or dataframe of vector embeddings of text, may be memory-mapped
     :param df_meta: dataframe containing corresponding metadata
+    :param progress: callback taking the fraction done and a message
+    :param bot: name of the bot the upload belongs to, see app.reduction.bot_name
     :return: scaled vector embeddings, 2D UMAP embedding w/ metadata
     """
-    reducer = umap.UMAP(n_components=2)
-    # reducer = umap.UMAP(n_components=3)
-
-    data = df_vec[df_vec.columns].values
-    print("Scaling data")
-    scaled_data = StandardScaler().fit_transform(data)
-    print("Fitting to UMAP")
-    embedding = reducer.fit_transform(scaled_data, y=df_meta['FAQ_id'])
+    data = df_vec.values if isinstance(df_vec, pd.DataFrame) else df_vec
+    saved = load_reducer(bot, data.shape[1]) if bot else None
+    if saved is not None:
+        progress(0.05, "Scaling data with the saved reducer for " + bot)
+        with span('analysis.scale', rows=len(data)):
+            scaled_data = transform_chunks(data, saved['scaler'], data.shape[1])
+        progress(0.15, "Projecting with the saved UMAP for " + bot)
+        with span('analysis.umap_transform', rows=len(data)):
+            embedding = transform_chunks(scaled_data, saved['umap'], 2)
+    else:
+        progress(0.05, "Scaling data")
+        with span('analysis.scale', rows=len(data)):
+            if len(data) > LARGE_DATA_ROWS:
+                scaler = fit_scaler(data)
+                scaled_data = transform_chunks(data, scaler, data.shape[1])
+            else:
+                scaler = StandardScaler()
+                scaled_data = scaler.fit_transform(np.asarray(data, dtype=np.float32)).astype(np.float32, copy=False)
+        progress(0.15, "Fitting to UMAP")
+        with span('analysis.umap_fit') as s:
+            reducer, sample, sample_embedding = fit_umap(scaled_data, df_meta['FAQ_id'])
+            s['rows'] = len(sample)
+        if len(sample) < len(scaled_data):
+            progress(0.5, "Projecting remaining rows")
+            with span('analysis.umap_transform', rows=len(scaled_data)):
+                embedding = transform_chunks(scaled_data, reducer, 2)
+            embedding[sample] = sample_embedding
+        else:
+            embedding = sample_embedding
+        if bot:
+            save_reducer(bot, scaler, reducer)
     print("Embedding shape: " + str(embedding.shape))
     embedding_df = pd.DataFrame(embedding, columns=['x', 'y'])
-    # embedding_df = pd.DataFrame(embedding, columns=['x', 'y', 'z'])
     final_df = embedding_df.join(df_meta)
     return scaled_data, final_df
 
 
-def embed_text(text):
+@timed()
+def analyse_upload(key, df_vec, df_meta, progress=_no_progress, bot=None):
+    """
+    Runs as a background job, see app.jobs. Results are stored under the key, see app.datasets.
+    :param key: content hash of the uploaded files
+    :param df_vec: matrix or dataframe of vector embeddings of text
+    :param df_meta: dataframe containing corresponding metadata
+    :param progress: callback taking the fraction done and a message
+    :param bot: name of the bot the upload belongs to, its reducer is reused and saved
+    :return: the key
+    """
+    if has_dataset(key):
+        return key
+    scaled_data, embedding_df = load_data(df_vec, df_meta, progress, bot)
+    progress(0.8, "Fitting LOF")
+    outliers = get_outliers(scaled_data, embedding_df)
+    progress(0.95, "Storing results")
+    save_dataset(key, scaled_data, embedding_df, outliers, outliers_name())
+    return key
+
+
+def analyse_files(key, vec, meta, bot=None, progress=_no_progress):
+    """
+    Runs as a background job, so parsing also happens outside the web worker.
+    :param key: content hash of the files
+    :param vec: (path or bytes, filename) of the vector embeddings
+    :param meta: (path or bytes, filename) of the metadata
+    :param bot: bot id given by the user, otherwise taken from the vector file name if it has one
+    :param progress: callback taking the fraction done and a message
+    :return: the key
+    """
+    progress(0.01, "Reading files")
+    vecs = read_upload(vec[0], vec[1], True)
+    df_meta = read_upload(meta[0], meta[1], False)
+    print("Vectors shape: " + str(vecs.shape))
+    return analyse_upload(key, vecs, df_meta, progress, bot=bot_name(vec[1], bot))
+
+
+def embed_text(text, model_url=USE_MODEL_URL):
     """
     :param text: raw text data
-    :return: dataframe of vector embeddings
+    :param model_url: sentence encoder, see app.centroids for routing markets to other models
+    :return: float32 array of vector embeddings
     """
-    module_url = "https://tfhub.dev/google/universal-sentence-encoder/4"
-    embed = hub.load(module_url)
-    vecs = embed(text)
-    return pd.DataFrame(vecs)
+    return embed(text, model_url=model_url)
 
 
+@timed()
 def reduce(dataframe, n_comp=200):
     """
-    :param dataframe: dataframe of vector embeddings of text
+    :param dataframe: dataframe or matrix of vector embeddings of text
     :param n_comp: number of components to reduce down to
     :return: reduced vector embeddings, reducer
     """
-    reducer = PCA(n_components=n_comp)
-    scaled_data = StandardScaler().fit_transform(dataframe)
-    embedding = reducer.fit_transform(scaled_data)
+    data = dataframe.values if isinstance(dataframe, pd.DataFrame) else dataframe
+    if len(data) > LARGE_DATA_ROWS:
+        scaled_data = transform_chunks(data, fit_scaler(data), data.shape[1])
+        reducer = fit_incremental_pca(scaled_data, n_comp)
+        embedding = transform_chunks(scaled_data, reducer, n_comp)
+    else:
+        reducer = PCA(n_components=n_comp)
+        scaled_data = StandardScaler().fit_transform(data)
+        embedding = reducer.fit_transform(scaled_data)
     embedding = pd.DataFrame(embedding)
     return embedding, reducer
 
 
-def get_outliers(embedded_df, reduced_df):
+def outliers_name(backend=LOF_BACKEND, partition=OUTLIER_PARTITION):
+    """
+    :return: name the outliers of a dataset are stored under, see app.datasets
+    """
+    if partition == 'global':
+        return "outliers-" + backend
+    return "outliers-" + backend + "-" + partition
+
+
+@timed()
+def get_outliers(embedded_df, reduced_df, backend=LOF_BACKEND, partition=OUTLIER_PARTITION):
     """
     :param embedded_df: full vector embeddings of text
     :param reduced_df: reduced vector embeddings of text
+    :param backend: neighbour backend for LOF, "exact" or "hnsw"
+    :param partition: "global" for one LOF over all data, "faq" or "faq_market" for one LOF per FAQ (and market)
     :return: dataframe containing x, y-coords, outlier score, and corresponding metadata
     """
-    lof = LocalOutlierFactor(n_neighbors=10, contamination='auto')
-    # Fit LOF on raw data
-    outlier_scores = lof.fit_predict(embedded_df)
+    if partition == 'global':
+        lof = make_lof(n_neighbors=10, backend=backend)
+        # Fit LOF on raw data
+        outlier_scores = lof.fit_predict(embedded_df)
+        negative_outlier_factor = lof.negative_outlier_factor_
+    else:
+        # outliers relative to their own FAQ, i.e. likely mislabelled examples
+        groups = reduced_df['FAQ_id'].astype(str)
+        if partition == 'faq_market' and 'market' in reduced_df:
+            groups = groups + '/' + reduced_df['market'].astype(str)
+        outlier_scores, negative_outlier_factor = partitioned_lof(embedded_df, groups.values, n_neighbors=10,
+                                                                  backend=backend)
 
     joined = reduced_df.join(pd.DataFrame(outlier_scores, columns=['outlier_score']))
-    joined['negative_outlier_factor'] = lof.negative_outlier_factor_
+    joined['negative_outlier_factor'] = negative_outlier_factor
 
     outliers = joined.loc[joined['outlier_score'] == -1]
     outlier_cats = outliers.FAQ_id.unique()
@@ -78,16 +175,14 @@ def get_outliers(embedded_df, reduced_df):
     return final_df
 
 
-def get_novelties(train_data, something_else, pos, neg):
+def get_novelties(clf, something_else, pos, neg):
     """
-    :param train_data: vector embeddings of text train data
+    :param clf: novelty LOF fitted on vector embeddings of text train data
     :param something_else: vector embeddings of "something else" user utterances
     :param pos: vector embeddings of user utterances resulting in positive feedback
     :param neg: vector embeddings of user utterances resulting in negative feedback
     :return: novelty scores of all data passed in
     """
-    clf = LocalOutlierFactor(n_neighbors=20, novelty=True, contamination='auto')
-    clf.fit(train_data)
     y_train_scores = clf.negative_outlier_factor_
     y_train_scores = pd.DataFrame(y_train_scores, columns=['score'])
     y_train_scores['dataset'] = 'train'
@@ -111,6 +206,7 @@ def get_novelties(train_data, something_else, pos, neg):
     return scores
 
 
+@timed()
 def get_novel_scores(something_else, pos, neg):
     """
     :param something_else: "something else" user utterances
@@ -119,44 +215,67 @@ def get_novel_scores(something_else, pos, neg):
     :return: novelty scores of all data passed in
     """
     print("Embedding text...")
-    something_else_vecs = embed_text(something_else)
-    pos_vecs = embed_text(pos)
-    neg_vecs = embed_text(neg)
-
-    # replace with actual trained dataset
-    # train_vecs = pd.read_csv("./data/extracted_n26_tsv_vecs.tsv", delimiter='\t|,', header=None, engine='python')
-    train_vecs = pd.read_csv("C:/Users/mrric/!Projects/Algomo/ChatbotAnalytics/data/extracted_n26_tsv_vecs.tsv",
-                             delimiter='\t|,', header=None, engine='python')
-    train_vecs = train_vecs.drop(train_vecs.columns[0], axis=1)
-
-    print("Fitting LOF...")
-    scores = get_novelties(train_vecs, something_else_vecs, pos_vecs, neg_vecs)
+    # one pass over all utterances so batches are filled across the three sets
+    vecs = embed_text(pd.concat([something_else, pos, neg]))
+    something_else_vecs = vecs[:len(something_else)]
+    pos_vecs = vecs[len(something_else):len(something_else) + len(pos)]
+    neg_vecs = vecs[len(something_else) + len(pos):]
+
+    clf = get_novelty_model()
+    scores = get_novelties(clf, something_else_vecs, pos_vecs, neg_vecs)
     return scores
 
 
-def novel_df():
+@timed()
+def get_centroid_scores(something_else_triggers, pos_feedback, neg_feedback):
+    """
+    :param something_else_triggers: user utterances that triggered a "something else" press
+    :param pos_feedback: user utterances resulting in positive feedback
+    :param neg_feedback: user utterances resulting in negative feedback
+    :return: novelty scores against the centroids of each utterance's market, see app.centroids
     """
+    texts = pd.concat([something_else_triggers['text'].astype(object), pos_feedback['utterance'],
+                       neg_feedback['utterance']])
+    markets = pd.concat([something_else_triggers['market'].astype(object), pos_feedback['market'],
+                         neg_feedback['market']])
+    scores = score_by_market(texts.values, markets.values)
+    scores['dataset'] = (['something else'] * len(something_else_triggers) +
+                         ['positive feedback'] * len(pos_feedback) + ['negative feedback'] * len(neg_feedback))
+    return scores
+
+
+@timed()
+def novel_df(something_else_triggers, pos_feedback, neg_feedback):
+    """
+    :param something_else_triggers: user utterances that triggered a "something else" press
+    :param pos_feedback: user utterances resulting in positive feedback
+    :param neg_feedback: user utterances resulting in negative feedback
     :return: dataframe containing novelty scores of user feedback w/ metadata
     """
-    novelty_scores = get_novel_scores(something_else_triggers['text'], pos_feedback['utterance'],
-                                      neg_feedback['utterance'])
-    txt_frames = [something_else_triggers['text'], pos_feedback['utterance'], neg_feedback['utterance']]
-    mkt_frames = [something_else_triggers['market'], pos_feedback['market'], neg_feedback['market']]
-
-    novel = pd.DataFrame()
-    novel['score'] = novelty_scores[novelty_scores['dataset'] != 'train']['score'].reset_index(drop=True)
-    novel['dataset'] = novelty_scores[novelty_scores['dataset'] != 'train']['dataset'].reset_index(drop=True)
-    novel['market'] = pd.concat(mkt_frames).reset_index(drop=True)
-    novel['text'] = pd.concat(txt_frames).reset_index(drop=True)
-
-    novel['top intent'] = None
-    novel['confidence'] = None
-    novel['top intent'].loc[novel['dataset'] == 'positive feedback'] = pos_feedback['faq_id']
-    novel['top intent'].loc[novel['dataset'] == 'negative feedback'] = neg_feedback['faq_id']
-    top_intents = [sub['intent'] for sub in something_else_triggers['top_intent']]
-    confidences = [sub['confidence'] for sub in something_else_triggers['top_intent']]
-    novel['top intent'].loc[novel['dataset'] == 'something else'] = top_intents
-    novel['confidence'].loc[novel['dataset'] == 'something else'] = confidences
+    if NOVELTY_METHOD == 'centroid':
+        novelty_scores = get_centroid_scores(something_else_triggers, pos_feedback, neg_feedback)
+    else:
+        novelty_scores = get_novel_scores(something_else_triggers['text'], pos_feedback['utterance'],
+                                          neg_feedback['utterance'])
+        novelty_scores = novelty_scores[novelty_scores['dataset'] != 'train'].reset_index(drop=True)
+
+    def frame(text, market, top_intent, confidence):
+        return pd.DataFrame({'market': np.asarray(market, dtype=object), 'text': np.asarray(text, dtype=object),
+                             'top intent': np.asarray(top_intent, dtype=object),
+                             'confidence': np.asarray(confidence, dtype=np.float32)})
+
+    no_confidence = np.full(len(pos_feedback) + len(neg_feedback), np.nan)
+    novel = pd.concat([
+        frame(something_else_triggers['text'], something_else_triggers['market'], something_else_triggers['intent'],
+              something_else_triggers['confidence']),
+        frame(pos_feedback['utterance'], pos_feedback['market'], pos_feedback['faq_id'],
+              no_confidence[:len(pos_feedback)]),
+        frame(neg_feedback['utterance'], neg_feedback['market'], neg_feedback['faq_id'],
+              no_confidence[len(pos_feedback):]),
+    ], ignore_index=True)
+    novel.insert(0, 'score', novelty_scores['score'].values)
+    novel.insert(1, 'dataset', novelty_scores['dataset'].astype('category').values)
+    novel['market'] = novel['market'].astype('category')
     return novel
 
 
@@ -165,40 +284,14 @@ def analyze_mkts(novel):
     :param novel: dataframe containing novelty scores of user feedback w/ metadata
     :return: dataframe containing various analytics for each market
     """
-    analysis = []
-    for market in novel['market'].unique():
-        mkt_cond = novel['market'] == market
-        num_pos = len(novel[(novel['dataset'] == 'positive feedback') & mkt_cond])
-        num_neg = len(novel[(novel['dataset'] == 'negative feedback') & mkt_cond])
-        num_something_else = len(novel[(novel['dataset'] == 'something else') & mkt_cond])
-        avg_confidence = novel[mkt_cond]['confidence'].mean()
-        avg_novelty = novel[mkt_cond]['score'].mean()
-        analysis.append((market, num_pos, num_neg, num_something_else, avg_confidence, avg_novelty))
-    analysis_df = pd.DataFrame(analysis, columns=['market', 'positive feedbacks', 'negative feedbacks',
-                                                  'something else', 'avg top intent confidence', 'avg novelty score'])
-    return analysis_df
+    return market_summary(aggregate_feedback(novel))
 
 
-def confidence_over_time():
+def confidence_over_time(intent_rollup, freq="1W", market=None):
     """
-    :return: dataframe containing average weekly confidence of the top intents
+    :param intent_rollup: confidence aggregates per market, intent and day
+    :param freq: length of each period
+    :param market: restrict to one market if given
+    :return: dataframe containing average confidence of the top intents per period
     """
-    confidence_map = []
-    for intent_dict in all_messages['top_intent']:
-        if 'confidence' in intent_dict.keys():
-            confidence_map.append(True)
-        else:
-            confidence_map.append(False)
-    x = all_messages[confidence_map]
-    df = pd.DataFrame()
-    top_intents = [sub['intent'] for sub in x['top_intent']]
-    confidences = [sub['confidence'] for sub in x['top_intent']]
-    df['top intent'] = top_intents
-    df['confidence'] = pd.to_numeric(confidences)
-    # df['market'] = something_else_triggers['market']
-
-    df['timestamp'] = x['ts_in_db'].reset_index(drop=True)
-    df = df.groupby(pd.Grouper(key="timestamp", freq="1W")).mean()
-    df['timestamp'] = df.index
-    return df
-
+    return confidence_by_period(intent_rollup, freq, market)
@@ -1,16 +1,28 @@
 import base64
-import io
+import json
+import os
+import time
 import plotly.express as px
 import plotly.graph_objects as go
 import pandas as pd
 import dash
+import flask
+from urllib.parse import urlencode
 from dash.dependencies import Input, Output, State
 import dash_core_components as dcc
 import dash_html_components as html
 import dash_bootstrap_components as dbc
 import dash_table
 
-from app.analysis import get_outliers, load_data, novel_df, analyze_mkts, confidence_over_time
+from app.analysis import analyse_files, get_outliers, outliers_name
+from app.context import DataContext
+from app.metrics import registry, rss_bytes, timed
+from app.novelty import score_utterances, scoring_latency
+from app.tables import query_frame, page_records, iter_csv, PAGE_SIZE
+from app.figures import content_key, downsample, results, WEBGL_THRESHOLD
+from app.jobs import jobs, FAILED, CANCELLED
+from app.datasets import has_dataset, load_dataset, load_outliers, save_outliers
+from app.uploads import save_stream, upload_path
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.FLATLY])
@@ -18,85 +30,171 @@ app.scripts.config.serve_locally = True
 app.css.config.serve_locally = True
 application = app.server
 
-raw_data = None
-embedded_data = pd.DataFrame()
-novel = novel_df()
-mkt_analysis = analyze_mkts(novel)
-time_series = confidence_over_time()
+context = DataContext()
+# load analytics after the server is up instead of at import time
+application.before_first_request(context.warm)
 
 
-def parse_content(content, filename, is_vec):
-    content_type, content_string = content.split(',')
-    decoded = base64.b64decode(content_string)
-    try:
-        if 'csv' in filename:
-            df = pd.read_csv(io.StringIO(decoded.decode('utf-8')), header=None)
-        elif 'tsv' in filename:
-            df = pd.read_csv(io.StringIO(decoded.decode('utf-8')), delimiter='\t', header=None)
-        elif 'xls' in filename:
-            df = pd.read_excel(io.BytesIO(decoded), header=None)
-        if is_vec:
-            df = df.drop(df.columns[0], axis=1)
-        else:
-            df.columns = df.iloc[0]
-            df = df[1:].reset_index(drop=True)
-        return df
-    except Exception as e:
-        print(e)
-        return html.Div([
-            'There was an error processing this file.'
-        ])
+@application.before_request
+def start_request_timer():
+    flask.g.request_start = time.perf_counter()
+
+
+@application.after_request
+def record_request(response):
+    """
+    Records every request as an http.<route> span, Dash callbacks as http.dash.<output>.
+    Unlike the callback.* spans this includes serialising the returned figures and tables.
+    """
+    start = getattr(flask.g, 'request_start', None)
+    if start is not None:
+        rule = flask.request.url_rule
+        name = 'http.' + (rule.rule if rule is not None else 'unmatched')
+        if flask.request.path.endswith('/_dash-update-component'):
+            name = 'http.dash.' + str((flask.request.get_json(silent=True) or {}).get('output'))
+        registry.record(name, time.perf_counter() - start, status=response.status_code,
+                        bytes=response.calculate_content_length())
+    return response
+
 
+@application.route('/metrics')
+def metrics():
+    """
+    Spans recorded by this server process. Spans of background jobs only appear in the METRICS_LOG file, if one is set.
+    """
+    return flask.jsonify({'pid': os.getpid(), 'rss_mb': rss_bytes() / 2 ** 20, 'spans': registry.snapshot(),
+                          'novelty_scoring': scoring_latency.summary()})
 
-def parse_contents(list_of_contents, list_of_names):
+
+def parse_contents(list_of_contents, list_of_names, bot=None):
+    files = {}
     for contents, filename in zip(list_of_contents, list_of_names):
+        content_type, content_string = contents.split(',')
         if 'vec' in filename:
-            df_vec = parse_content(contents, filename, True)
-            print(df_vec.head)
+            files['vec'] = (base64.b64decode(content_string), filename)
         if 'meta' in filename:
-            df_meta = parse_content(contents, filename, False)
-            print(df_meta.head)
+            files['meta'] = (base64.b64decode(content_string), filename)
+    return submit_analysis(files, bot)
+
+
+def load_server_files(names, bot=None):
+    files = {}
+    for filename in names.split(','):
+        path = upload_path(filename.strip())
+        if 'vec' in path.name:
+            files['vec'] = (path, path.name)
+        if 'meta' in path.name:
+            files['meta'] = (path, path.name)
+    return submit_analysis(files, bot)
+
 
+def submit_analysis(files, bot=None):
     try:
-        global raw_data, embedded_data
-        raw_data, embedded_data = load_data(df_vec, df_meta)
+        key = content_key(files['vec'][0], files['meta'][0])
+        if has_dataset(key):
+            # the same files were analysed before, by this or another user
+            return display_job_progress(), {'job': None, 'key': key}
+        job_id = jobs.submit(analyse_files, key, files['vec'], files['meta'], bot, name='upload', key=key)
     except Exception as e:
         print(e)
         return html.Div([
             'There was an error processing this file.'
-        ])
+        ]), None
+    return display_job_progress(), {'job': job_id, 'key': key}
 
 
-def display_scatter():
-    print("Plotting scatterplot")
-    fig = px.scatter(embedded_data, x='x', y='y', color='FAQ_id', hover_name='question', title='UMAP Visualization')
-    # fig = px.scatter_3d(dataframe, x='x', y='y', z='z', color='FAQ_id', hover_name='question')
+@application.route('/api/upload/<filename>', methods=['POST', 'PUT'])
+def upload_file(filename):
+    """
+    Stream a large file to the upload directory, e.g. curl -T vecs.npy <host>/api/upload/vecs.npy
+    """
+    path = save_stream(flask.request.stream, filename)
+    return flask.jsonify({'filename': path.name})
+
+
+def display_job_progress():
     return html.Div(
         [
-            dcc.Graph(
-                id='scatterplot',
-                figure=fig
-            ),
+            dcc.Interval(id='job-poll', interval=1000),
+            dbc.Progress(id='job-progress', value=0, striped=True, animated=True),
+            html.Div(id='job-message', children='Waiting for a free worker'),
+            dbc.Button('Cancel', id='job-cancel', className="btn btn-secondary btn-sm"),
+            html.Span(id='job-cancelled'),
         ],
         style={"margin-left": "5%", "margin-right": "5%"}
     )
 
 
-def display_outliers():
-    outliers = get_outliers(raw_data, embedded_data)
+@timed('figure.scatter')
+def scatter_figure(df):
+    title = 'UMAP Visualization'
+    render_mode = 'webgl' if len(df) > WEBGL_THRESHOLD else 'svg'
+    points = downsample(df)
+    if len(points) < len(df):
+        title += ' ({} of {} points)'.format(len(points), len(df))
+    return px.scatter(points, x='x', y='y', color='FAQ_id', hover_name='question', title=title,
+                      render_mode=render_mode)
+
+
+@timed('figure.outliers')
+def outlier_figure(outliers):
+    is_outlier = outliers['outlier_score'] == 4
+    points = downsample(outliers, keep=is_outlier)
+    trace = go.Scattergl if len(outliers) > WEBGL_THRESHOLD else go.Scatter
     fig_outlier = go.Figure(
-        data=go.Scatter(
-            x=outliers['x'],
-            y=outliers['y'],
+        data=trace(
+            x=points['x'],
+            y=points['y'],
             mode='markers',
-            text=outliers['question'],
-            marker=dict(symbol=outliers['outlier_score'], color=outliers['FAQ_id'])
+            text=points['question'],
+            marker=dict(symbol=points['outlier_score'], color=points['FAQ_id'])
         ),
     )
     fig_outlier.update_layout(
         title='Outliers'
     )
-    table_data = outliers.drop(['outlier_score'], axis=1)[outliers['outlier_score'] == 4]
+    return fig_outlier
+
+
+def dataset_outliers(key):
+    name = outliers_name()
+
+    def compute():
+        outliers = load_outliers(key, name)
+        if outliers is None:
+            raw_data, embedded_data = load_dataset(key)
+            outliers = get_outliers(raw_data, embedded_data)
+            save_outliers(key, outliers, name)
+        return outliers
+    return results.get_or_compute(('outliers', key, outliers_name()), compute)
+
+
+def dataset_outlier_table(key):
+    def compute():
+        outliers = dataset_outliers(key)
+        return outliers.drop(['outlier_score'], axis=1)[outliers['outlier_score'] == 4]
+    return results.get_or_compute(('outlier_table', key, outliers_name()), compute)
+
+
+def display_scatter(key):
+    print("Plotting scatterplot")
+    fig = results.get_or_compute(('scatter', key), lambda: scatter_figure(load_dataset(key)[1]))
+    # fig = px.scatter_3d(dataframe, x='x', y='y', z='z', color='FAQ_id', hover_name='question')
+    return html.Div(
+        [
+            dcc.Graph(
+                id='scatterplot',
+                figure=fig
+            ),
+        ],
+        style={"margin-left": "5%", "margin-right": "5%"}
+    )
+
+
+def display_outliers(key):
+    fig_outlier = results.get_or_compute(('outlier_figure', key, outliers_name()),
+                                         lambda: outlier_figure(dataset_outliers(key)))
+    outlier_table = dataset_outlier_table(key)
     return html.Div(
         [
             dcc.Graph(
@@ -105,26 +203,66 @@ def display_outliers():
             ),
             dash_table.DataTable(
                 id='outlier_table',
-                columns=[{"name": i, "id": i} for i in table_data.columns],
-                data=table_data.to_dict('records'),
-                filter_action="native",
-                sort_action="native",
+                columns=[{"name": i, "id": i} for i in outlier_table.columns],
+                page_current=0,
+                page_size=PAGE_SIZE,
+                page_action="custom",
+                filter_action="custom",
+                filter_query="",
+                sort_action="custom",
+                sort_mode="multi",
+                sort_by=[],
                 css=[{'selector': '.row', 'rule': 'margin: 0'}],
-                export_format="csv",
-                export_headers="display",
             ),
+            html.A('Export CSV', id='outlier_table_download',
+                   href='/download/outliers.csv?' + urlencode({'key': key})),
         ],
         style={"margin-left": "5%", "margin-right": "5%"}
     )
 
 
+@application.route('/api/novelty', methods=['POST'])
+def score_novelty():
+    """
+    Score new utterances against the training data and add them to the novelty dataset.
+    Accepts {"utterances": [{"text": ..., "market": ..., "dataset": ..., "top intent": ..., "confidence": ...}]}
+    """
+    payload = flask.request.get_json(force=True)
+    if not isinstance(payload, dict):
+        return flask.jsonify({'error': 'expected a JSON object'}), 400
+    utterances = payload.get('utterances', [payload])
+    if not isinstance(utterances, list) or not all(isinstance(utterance, dict) for utterance in utterances):
+        return flask.jsonify({'error': 'utterances must be a list of objects'}), 400
+    rows = pd.DataFrame(utterances)
+    if 'text' not in rows.columns or rows['text'].isnull().any():
+        return flask.jsonify({'error': 'every utterance needs a text'}), 400
+    rows['score'] = score_utterances(rows['text'].tolist(), rows['market'].tolist() if 'market' in rows else None)
+    defaults = {'dataset': 'something else', 'market': None, 'top intent': None, 'confidence': None}
+    for column, default in defaults.items():
+        if column not in rows.columns:
+            rows[column] = default
+    context.append_novel(rows[['score', 'dataset', 'market', 'text', 'top intent', 'confidence']])
+    return flask.jsonify({'scores': rows['score'].tolist()})
+
+
+@application.route('/api/novelty/stats')
+def novelty_stats():
+    return flask.jsonify(scoring_latency.summary())
+
+
+def display_novelty_histogram():
+    return px.histogram(context.novel(), x='score', color='dataset', title='Histogram of Novelty Scores')
+
+
 def display_novelty():
-    histogram = px.histogram(novel, x='score', color='dataset', title='Histogram of Novelty Scores')
+    novel = context.novel()
+    histogram = display_novelty_histogram()
     mkt_feedback_bar = display_market_feedback()
     mkt_novel_bar = display_market_novelty()
     time_series_line = display_time_series()
     return html.Div(
         children=[
+            dcc.Interval(id='novelty-refresh', interval=10 * 1000),
             html.Div(dcc.Graph(id='novelty_hist', figure=histogram)),
             dbc.Row([
                 dbc.Col(dcc.Graph(id='mkt_feedback_bar', figure=mkt_feedback_bar), width=6),
@@ -135,21 +273,26 @@ def display_novelty():
             dash_table.DataTable(
                 id='novelty_table',
                 columns=[{"name": i, "id": i} for i in novel.columns],
-                data=novel.to_dict('records'),
                 fixed_rows={'headers': True},
                 style_table={'height': 500},
-                filter_action="native",
-                sort_action="native",
+                page_current=0,
+                page_size=PAGE_SIZE,
+                page_action="custom",
+                filter_action="custom",
+                filter_query="",
+                sort_action="custom",
+                sort_mode="multi",
+                sort_by=[],
                 css=[{'selector': '.row', 'rule': 'margin: 0'}],
-                export_format="csv",
-                export_headers="display",
-            )
+            ),
+            html.A('Export CSV', id='novelty_table_download', href='/download/novelty.csv')
         ],
         style={"margin-left": "5%", "margin-right": "5%", "margin-top": "5%", "margin-bottom": "5%"}
     )
 
 
 def display_market_feedback():
+    mkt_analysis = context.mkt_analysis()
     fig = go.Figure()
     fig.add_trace(go.Bar(x=mkt_analysis['market'],
                          y=mkt_analysis['positive feedbacks'],
@@ -179,6 +322,7 @@ def display_market_feedback():
 
 
 def display_market_novelty():
+    mkt_analysis = context.mkt_analysis()
     fig = go.Figure()
     fig.add_trace(go.Bar(x=mkt_analysis['market'],
                          y=mkt_analysis['avg top intent confidence'],
@@ -203,32 +347,83 @@ def display_market_novelty():
 
 
 def display_time_series():
-    fig = px.line(time_series, x="timestamp", y="confidence", title="Weekly Avg Chatbot Confidence"
+    fig = px.line(context.time_series(), x="timestamp", y="confidence", title="Weekly Avg Chatbot Confidence"
                   # color="market", line_group="market", hover_name="market"
                   )
     fig.update_xaxes(rangeslider_visible=True)
     return fig
 
 
-@app.callback(Output('output-data-upload', 'children'),
-              [Input('upload-data', 'contents')],
-              [State('upload-data', 'filename')])
-def update_output(list_of_contents, list_of_names):
-    if list_of_contents is not None:
-        children = [
-            parse_contents(list_of_contents, list_of_names)
-        ]
-        return children
+@app.callback([Output('output-data-upload', 'children'),
+               Output('upload-job', 'data')],
+              [Input('upload-data', 'contents'),
+               Input('server-files-btn', 'n_clicks')],
+              [State('upload-data', 'filename'),
+               State('server-files', 'value'),
+               State('bot-id', 'value')])
+@timed('callback.upload')
+def update_output(list_of_contents, n_clicks, list_of_names, server_files, bot):
+    triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+    if 'server-files-btn.n_clicks' in triggered and server_files:
+        children, job = load_server_files(server_files, bot)
+    elif list_of_contents is not None:
+        children, job = parse_contents(list_of_contents, list_of_names, bot)
+    else:
+        raise dash.exceptions.PreventUpdate
+    return [children], job
+
+
+@app.callback([Output('job-progress', 'value'),
+               Output('job-message', 'children'),
+               Output('job-poll', 'disabled'),
+               Output('session-dataset', 'data')],
+              [Input('job-poll', 'n_intervals')],
+              [State('upload-job', 'data')])
+@timed('callback.poll_job')
+def poll_job(n_intervals, job):
+    if not job:
+        raise dash.exceptions.PreventUpdate
+    if has_dataset(job['key']):
+        # finished by this job, or earlier by anyone uploading the same files
+        if job['job']:
+            jobs.pop_result(job['job'])
+        return 100, 'Analysis finished, open Model Analysis to explore it.', True, job['key']
+    status = jobs.status(job['job'])
+    if status['state'] == FAILED:
+        return 100, 'There was an error processing this file.', True, dash.no_update
+    if status['state'] == CANCELLED:
+        return 0, 'Cancelled.', True, dash.no_update
+    if status['state'] is None:
+        return 0, 'The analysis job was lost, please upload the files again.', True, dash.no_update
+    return int(status['progress'] * 100), status['message'], False, dash.no_update
+
+
+@app.callback(Output('job-cancelled', 'children'),
+              [Input('job-cancel', 'n_clicks')],
+              [State('upload-job', 'data')])
+@timed('callback.cancel_job')
+def cancel_job(n_clicks, job):
+    if not n_clicks or not job:
+        raise dash.exceptions.PreventUpdate
+    jobs.cancel(job['job'])
+    return ''
 
 
 @app.callback(
     dash.dependencies.Output('outlier-list', 'children'),
-    [dash.dependencies.Input('outliers-btn', 'n_clicks')])
-def update_output(n_clicks):
+    [dash.dependencies.Input('outliers-btn', 'n_clicks')],
+    [dash.dependencies.State('session-dataset', 'data')])
+@timed('callback.outliers_btn')
+def update_output(n_clicks, key):
     print(n_clicks)
     if n_clicks > 0:
+        if not has_dataset(key):
+            return html.Div(
+                    children="Please load data.",
+                    style={"margin-left": "25px", "margin-top": "25px"},
+                )
         try:
-            return display_outliers()
+            return display_outliers(key)
         except Exception as e:
             print(e)
             return html.Div(
@@ -237,13 +432,77 @@ def update_output(n_clicks):
                 )
 
 
-@app.callback(Output("tabs-figures", "children"), [Input("tabs", "value")])
-def render_tab(tab):
+TABLES = {
+    'novelty': lambda key: context.novel(),
+    'outliers': dataset_outlier_table,
+}
+
+
+@application.route('/download/<table>.csv')
+def download_table(table):
+    if table not in TABLES or (table == 'outliers' and not has_dataset(flask.request.args.get('key'))):
+        flask.abort(404)
+    key = flask.request.args.get('key')
+    try:
+        sort_by = json.loads(flask.request.args.get('sort', '[]'))
+    except ValueError:
+        flask.abort(400)
+    if not isinstance(sort_by, list) or not all(isinstance(col, dict) and 'column_id' in col for col in sort_by):
+        flask.abort(400)
+    df = query_frame((table, key), TABLES[table](key), flask.request.args.get('filter', ''), sort_by)
+    return flask.Response(iter_csv(df), mimetype='text/csv',
+                          headers={'Content-Disposition': 'attachment; filename=' + table + '.csv'})
+
+
+def table_callbacks(table_id, table):
+    @app.callback(Output(table_id, 'data'),
+                  [Input(table_id, 'page_current'),
+                   Input(table_id, 'page_size'),
+                   Input(table_id, 'sort_by'),
+                   Input(table_id, 'filter_query')],
+                  [State('session-dataset', 'data')])
+    @timed('callback.' + table_id + '_table')
+    def update_table(page_current, page_size, sort_by, filter_query, key):
+        if table == 'outliers' and not has_dataset(key):
+            raise dash.exceptions.PreventUpdate
+        df = query_frame((table, key), TABLES[table](key), filter_query, sort_by)
+        return page_records(df, page_current, page_size)
+
+    @app.callback(Output(table_id + '_download', 'href'),
+                  [Input(table_id, 'sort_by'),
+                   Input(table_id, 'filter_query')],
+                  [State('session-dataset', 'data')])
+    @timed('callback.' + table_id + '_download')
+    def update_download(sort_by, filter_query, key):
+        return '/download/' + table + '.csv?' + urlencode({'key': key or '',
+                                                           'filter': filter_query or '',
+                                                           'sort': json.dumps(sort_by or [])})
+
+
+table_callbacks('novelty_table', 'novelty')
+table_callbacks('outlier_table', 'outliers')
+
+
+@app.callback([Output('novelty_hist', 'figure'),
+               Output('mkt_feedback_bar', 'figure'),
+               Output('mkt_novel_bar', 'figure')],
+              [Input('novelty-refresh', 'n_intervals')])
+@timed('callback.refresh_novelty')
+def refresh_novelty(n_intervals):
+    # picks up utterances scored through /api/novelty since the tab was rendered
+    return display_novelty_histogram(), display_market_feedback(), display_market_novelty()
+
+
+@app.callback(Output("tabs-figures", "children"), [Input("tabs", "value"), Input("session-dataset", "data")])
+@timed('callback.render_tab')
+def render_tab(tab, key):
     try:
         if tab == "tab-0":
+            if not has_dataset(key):
+                raise ValueError("No dataset loaded in this session")
             return html.Div([
-                display_scatter(),
-                display_outliers(),
+                display_scatter(key),
+                display_outliers(key),
             ])
 
         elif tab == "tab-1":
@@ -275,11 +534,24 @@ app.layout = html.Div(children=[
         children=dbc.Button('Upload Files', style={"margin-left": "5%"}, className="btn btn-secondary btn-lg"),
         multiple=True),
     html.Div(
-        'Select one metadata file with text data and one file with the corresponding vector embeddings.',
+        'Select one metadata file with text data and one file with the corresponding vector embeddings. '
+        'Vectors can be .csv, .tsv, .xls, .npy, .parquet or .arrow.',
         style={"margin-left": "5%"}
     ),
+    html.Div(
+        [
+            dcc.Input(id='bot-id', type='text', placeholder='bot id, e.g. n26 (optional)',
+                      style={"margin-right": "10px"}),
+            dcc.Input(id='server-files', type='text', placeholder='vecs.npy, meta.parquet',
+                      style={"margin-right": "10px"}),
+            dbc.Button('Load from server', id='server-files-btn', className="btn btn-secondary btn-sm"),
+        ],
+        style={"margin-left": "5%", "margin-top": "10px"}
+    ),
     html.Hr(),
     html.Div(id='output-data-upload'),
+    dcc.Store(id='upload-job'),
+    dcc.Store(id='session-dataset', storage_type='session'),
 
     dcc.Tabs(
         id="tabs",
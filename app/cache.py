@@ -0,0 +1,367 @@
+import fcntl
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+from contextlib import contextmanager
+from pathlib import Path
+from app.database import db_get_faq_feedback_raw, db_iter_message_analytics_raw, split_feedback, \
+    iter_parsed_message_analytics, concat_parsed, previous_turns, parse_message_analytics, CHUNK_SIZE, \
+    SOMETHING_ELSE_INTENT
+from app.metrics import timed
+from app.rollups import aggregate_confidence, merge_rollup, CONFIDENCE_KEYS
+
+# local mirror of the append-only analytics tables, partitioned parquet datasets
+CACHE_DIR = Path(os.getenv("CACHE_DIR", "cache"))
+MESSAGES_DIR = CACHE_DIR / "message_analytics"
+FEEDBACK_DIR = CACHE_DIR / "faq_feedback_multilg"
+WATERMARKS = CACHE_DIR / "watermarks.json"
+INTENT_ROLLUP = CACHE_DIR / "rollups" / "intent_daily.parquet"
+# utterances scored through the API, one parquet file per request, shared by all workers
+SCORED_NOVELTY_DIR = CACHE_DIR / "scored_novelty"
+# parts are merged into one once there are more than this many
+SCORED_NOVELTY_MAX_PARTS = int(os.getenv("SCORED_NOVELTY_MAX_PARTS", 32))
+# partition value used for rows whose market could not be joined
+NO_MARKET = "__none__"
+MESSAGE_CACHE_COLUMNS = ['ts_in_db', 'top_intent', 'user_event', 'market', 'conversation_id']
+
+
+def read_watermarks():
+    """
+    :return: dict of table name to the highest ts_in_db / id already cached
+    """
+    if not WATERMARKS.exists():
+        return {}
+    with open(WATERMARKS) as f:
+        return json.load(f)
+
+
+def write_watermark(table, value):
+    """
+    :param table: name of the cached table
+    :param value: new high-water mark of the table
+    """
+    write_watermarks({table: value})
+
+
+def write_watermarks(values):
+    """
+    :param values: dict of name to new high-water mark, written together
+    """
+    with cache_lock("watermarks.lock"):
+        watermarks = read_watermarks()
+        watermarks.update(values)
+        tmp = WATERMARKS.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            json.dump(watermarks, f)
+        os.replace(tmp, WATERMARKS)
+
+
+@contextmanager
+def cache_lock(name):
+    """
+    Exclusive between all processes sharing CACHE_DIR, e.g. gunicorn workers warming up at the same time.
+    :param name: lock file in CACHE_DIR
+    :return: context manager holding the lock
+    """
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    with open(CACHE_DIR / name, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def message_keys(df):
+    """
+    :param df: raw message_analytics rows
+    :return: stable hash of each row, to recognise rows already cached at the watermark timestamp
+    """
+    return pd.util.hash_pandas_object(df[['conversation_id', 'top_intent', 'user_event']].astype(str),
+                                      index=False).astype(str).values
+
+
+def _write_partitions(df, path, partition_cols):
+    df = df.copy()
+    df['market'] = df['market'].fillna(NO_MARKET)
+    df.to_parquet(str(path), engine='pyarrow', partition_cols=partition_cols, index=False)
+
+
+def _iter_partitions(path, columns, batch_size=CHUNK_SIZE, filter=None):
+    """
+    Reads the dataset batch by batch, so the mirror is never loaded whole.
+    :param path: partitioned parquet dataset
+    :param columns: columns to read, the others are not decoded
+    :param batch_size: maximum number of rows per frame
+    :param filter: pyarrow.dataset expression selecting rows, pushed down to the reader
+    :return: generator of frames of the selected rows
+    """
+    if not path.exists():
+        return
+    dataset = ds.dataset(str(path), format='parquet', partitioning='hive')
+    for batch in dataset.to_batches(columns=columns, filter=filter, batch_size=batch_size):
+        if batch.num_rows:
+            df = batch.to_pandas()
+            if 'market' in df:
+                df['market'] = df['market'].astype(object).where(df['market'] != NO_MARKET, None)
+            yield df
+
+
+def _read_partitions(path, columns, filter=None):
+    frames = list(_iter_partitions(path, columns, filter=filter))
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True)
+
+
+def _cached_days():
+    if not MESSAGES_DIR.exists():
+        return []
+    return sorted(path.name.split('=', 1)[1] for path in MESSAGES_DIR.glob('day=*'))
+
+
+@timed()
+def sync_message_analytics(chunk_size=CHUNK_SIZE):
+    """
+    Append message_analytics rows not yet cached to the local cache.
+    Rows are fetched from the ts_in_db high-water mark inclusive, since more rows with the same timestamp can
+    arrive later, and rows at that timestamp which are already cached are recognised by message_keys.
+    :param chunk_size: number of rows fetched from the server at a time
+    :return: number of new rows cached
+    """
+    # the watermark is only read once the lock is held, so concurrent syncs never fetch the same rows
+    with cache_lock("sync.lock"):
+        return _sync_message_analytics(chunk_size)
+
+
+def _sync_message_analytics(chunk_size):
+    watermarks = read_watermarks()
+    since = watermarks.get("message_analytics")
+    seen = set(watermarks.get("message_analytics_seen", []))
+    # caches written before the seen rows were recorded fetched strictly after the watermark
+    legacy = since is not None and "message_analytics_seen" not in watermarks
+    rollup_current = watermarks.get("intent_rollup") == since and (since is None or INTENT_ROLLUP.exists())
+    rollup = load_intent_rollup() if rollup_current else None
+    num_new = 0
+    for chunk in db_iter_message_analytics_raw(since=since, chunk_size=chunk_size):
+        ts = pd.to_datetime(chunk['ts_in_db'])
+        keys = message_keys(chunk)
+        if since is not None:
+            new = ~((ts == pd.Timestamp(since)).values & (legacy | pd.Series(keys).isin(seen).values))
+            chunk, ts, keys = chunk[new], ts[new], keys[new]
+        if chunk.empty:
+            continue
+        chunk = chunk.assign(day=ts.dt.strftime('%Y-%m-%d'))
+        _write_partitions(chunk, MESSAGES_DIR, ['day', 'market'])
+        # rows arrive ordered by ts_in_db, so the watermark can advance per chunk
+        latest = ts.max()
+        if since is None or latest != pd.Timestamp(since):
+            seen = set()
+        seen.update(keys[(ts == latest).values])
+        since = str(latest)
+        write_watermarks({"message_analytics": since, "message_analytics_seen": sorted(seen)})
+        if rollup is not None:
+            rollup = merge_rollup(rollup, aggregate_confidence(parse_message_analytics(chunk, False)), CONFIDENCE_KEYS)
+        num_new += len(chunk)
+    if rollup is not None and num_new:
+        save_intent_rollup(rollup, since)
+    print("Cached " + str(num_new) + " new message_analytics rows")
+    return num_new
+
+
+def load_intent_rollup():
+    """
+    :return: cached confidence aggregates per market, intent and day
+    """
+    if not INTENT_ROLLUP.exists():
+        return pd.DataFrame(columns=CONFIDENCE_KEYS + ['count', 'confidence_sum', 'confidence_sumsq'])
+    return pd.read_parquet(str(INTENT_ROLLUP), engine='pyarrow')
+
+
+def save_intent_rollup(rollup, watermark):
+    """
+    :param rollup: confidence aggregates per market, intent and day
+    :param watermark: message_analytics high-water mark the aggregates are up to date with
+    """
+    INTENT_ROLLUP.parent.mkdir(parents=True, exist_ok=True)
+    tmp = INTENT_ROLLUP.with_suffix(".tmp")
+    rollup.to_parquet(str(tmp), engine='pyarrow', index=False)
+    os.replace(tmp, INTENT_ROLLUP)
+    write_watermark("intent_rollup", watermark)
+
+
+@timed()
+def rebuild_intent_rollup(chunk_size=CHUNK_SIZE):
+    """
+    Recompute the confidence aggregates from all cached messages.
+    :param chunk_size: number of cached rows parsed at a time
+    :return: confidence aggregates per market, intent and day
+    """
+    watermark = read_watermarks().get("message_analytics")
+    rollup = None
+    for raw in _iter_partitions(MESSAGES_DIR, MESSAGE_CACHE_COLUMNS, chunk_size):
+        chunk = parse_message_analytics(raw, False)
+        rollup = merge_rollup(rollup, aggregate_confidence(chunk), CONFIDENCE_KEYS)
+    if rollup is None:
+        return load_intent_rollup()
+    save_intent_rollup(rollup, watermark)
+    return rollup
+
+
+def cached_intent_rollup(sync=True, chunk_size=CHUNK_SIZE):
+    """
+    :param sync: fetch new rows from the database before reading the cache
+    :param chunk_size: number of rows fetched or parsed at a time
+    :return: confidence aggregates per market, intent and day, covering every cached message
+    """
+    if sync:
+        sync_message_analytics(chunk_size)
+    with cache_lock("sync.lock"):
+        watermarks = read_watermarks()
+        if watermarks.get("intent_rollup") != watermarks.get("message_analytics") or not INTENT_ROLLUP.exists():
+            return rebuild_intent_rollup(chunk_size)
+        return load_intent_rollup()
+
+
+@timed()
+def sync_faq_feedback():
+    """
+    Append faq_feedback_multilg rows newer than the cached id high-water mark to the local cache.
+    :return: number of new rows cached
+    """
+    with cache_lock("sync.lock"):
+        since_id = read_watermarks().get("faq_feedback_multilg")
+        result = db_get_faq_feedback_raw(since_id=since_id)
+        if len(result):
+            _write_partitions(result, FEEDBACK_DIR, ['market'])
+            write_watermark("faq_feedback_multilg", int(result['id'].max()))
+    print("Cached " + str(len(result)) + " new faq_feedback_multilg rows")
+    return len(result)
+
+
+def cached_faq_feedback(sync=True):
+    """
+    :param sync: fetch new rows from the database before reading the cache
+    :return: user utterances resulting in positive and negative feedback
+    """
+    if sync:
+        sync_faq_feedback()
+    result = _read_partitions(FEEDBACK_DIR, ['id', 'utterance', 'correct', 'faq_id', 'market'])
+    result = result.sort_values('id').reset_index(drop=True)
+    return split_feedback(result)
+
+
+def cached_message_analytics(something_else, sync=True, chunk_size=CHUNK_SIZE):
+    """
+    :param something_else: return only something else triggers if true, otherwise return all text
+    :param sync: fetch new rows from the database before reading the cache
+    :param chunk_size: number of cached rows parsed at a time
+    :return: user utterances from message_analytics
+    """
+    if sync:
+        sync_message_analytics(chunk_size)
+    if something_else:
+        chunks = _iter_cached_triggers(chunk_size)
+    else:
+        chunks = _iter_cached_messages(chunk_size)
+    return concat_parsed(iter_parsed_message_analytics(chunks))
+
+
+def _iter_cached_messages(chunk_size):
+    # one day of raw rows at a time, ordered by ts_in_db
+    for day in _cached_days():
+        raw = _read_partitions(MESSAGES_DIR, MESSAGE_CACHE_COLUMNS, ds.field('day') == day)
+        raw = raw.sort_values('ts_in_db', kind='mergesort').reset_index(drop=True)
+        for i in range(0, len(raw), chunk_size):
+            yield raw.iloc[i:i + chunk_size]
+
+
+def _iter_cached_triggers(chunk_size):
+    # only conversations containing a something else press are read in full, like the LAG query
+    conversations = set()
+    for df in _iter_partitions(MESSAGES_DIR, ['conversation_id'], chunk_size,
+                               ds.field('top_intent') == SOMETHING_ELSE_INTENT):
+        conversations.update(df['conversation_id'])
+    if not conversations:
+        return
+    raw = _read_partitions(MESSAGES_DIR, MESSAGE_CACHE_COLUMNS,
+                           ds.field('conversation_id').isin(sorted(conversations)))
+    raw = previous_turns(raw).reset_index(drop=True)
+    for i in range(0, len(raw), chunk_size):
+        yield raw.iloc[i:i + chunk_size]
+
+
+def save_scored_novelty(rows):
+    """
+    :param rows: newly scored utterances with the columns of the novelty dataset
+    :return: name of the part the rows were written to
+    """
+    rows = rows.copy()
+    top_intent = rows['top intent'].astype(object)
+    # faq ids and intent names in one column, stored as strings so the parts share a schema
+    rows['top intent'] = top_intent.where(top_intent.isna(), top_intent.astype(str))
+    rows['market'] = rows['market'].astype(object)
+    rows['dataset'] = rows['dataset'].astype(str)
+    rows['score'] = pd.to_numeric(rows['score']).astype(np.float32)
+    rows['confidence'] = pd.to_numeric(rows['confidence']).astype(np.float32)
+    SCORED_NOVELTY_DIR.mkdir(parents=True, exist_ok=True)
+    name, tmp = _scored_part_name()
+    rows.to_parquet(str(tmp), engine='pyarrow', index=False)
+    os.replace(tmp, SCORED_NOVELTY_DIR / name)
+    if len(scored_novelty_parts()) > SCORED_NOVELTY_MAX_PARTS:
+        compact_scored_novelty()
+    return name
+
+
+def _scored_part_name():
+    name = "part-{}-{}.parquet".format(time.time_ns(), os.getpid())
+    return name, SCORED_NOVELTY_DIR / (name + ".tmp")
+
+
+def compact_scored_novelty(max_parts=SCORED_NOVELTY_MAX_PARTS):
+    """
+    Merge the parts of scored utterances into one, so readers open few files.
+    :param max_parts: only compact if there are more parts than this
+    """
+    with cache_lock("scored_novelty.lock"):
+        parts = scored_novelty_parts()
+        if len(parts) <= max_parts:
+            return
+        rows = pd.concat(load_scored_novelty(parts), ignore_index=True)
+        name, tmp = _scored_part_name()
+        rows.to_parquet(str(tmp), engine='pyarrow', index=False)
+        # the old parts go first, so a reader may briefly miss these rows but never counts them twice
+        for part in parts:
+            (SCORED_NOVELTY_DIR / part).unlink()
+        os.replace(tmp, SCORED_NOVELTY_DIR / name)
+
+
+def scored_novelty_version():
+    """
+    :return: modification time of the directory of scored utterances, which changes whenever a part is added
+        or removed, None if nothing was scored yet
+    """
+    try:
+        return SCORED_NOVELTY_DIR.stat().st_mtime_ns
+    except OSError:
+        return None
+
+
+def scored_novelty_parts():
+    """
+    :return: names of the parts of scored utterances written so far, oldest first
+    """
+    if not SCORED_NOVELTY_DIR.exists():
+        return []
+    return sorted(path.name for path in SCORED_NOVELTY_DIR.glob("part-*.parquet"))
+
+
+def load_scored_novelty(parts):
+    """
+    :param parts: names returned by scored_novelty_parts
+    :return: list of the scored utterances of each part
+    """
+    return [pd.read_parquet(str(SCORED_NOVELTY_DIR / part), engine='pyarrow') for part in parts]
@@ -0,0 +1,198 @@
+import hashlib
+import json
+import os
+import threading
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from app.embedding import embed, USE_MODEL_URL
+from app.metrics import span
+from app.novelty import MODEL_DIR, TRAIN_VECS_PATH, _save_atomic, load_train_vectors, train_key
+from app.uploads import read_upload
+
+# JSON file of embedding profiles and the markets routed to them, e.g.
+# {"default": "en",
+#  "profiles": {"en": {"model": "<hub handle or local path>", "train_meta": "data/en_meta.tsv",
+#                      "train_vecs": "data/en_vecs.tsv"},
+#               "multi": {"model": "<multilingual encoder>", "train_meta": "data/de_fr_meta.tsv"}},
+#  "markets": {"de": "multi", "fr": "multi"}}
+# train_meta needs FAQ_id and question columns, without train_vecs the questions are embedded with the model.
+MODEL_REGISTRY_PATH = Path(os.getenv("MODEL_REGISTRY_PATH", MODEL_DIR / "registry.json"))
+TRAIN_META_PATH = Path(os.getenv("TRAIN_META_PATH", "./data/extracted_n26_tsv_meta.tsv"))
+CENTROID_DIR = MODEL_DIR / "centroids"
+# rows scored against the centroids at a time, bounds the rows x FAQs similarity matrix
+SCORE_CHUNK_SIZE = 8192
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def load_model_registry(path=MODEL_REGISTRY_PATH):
+    """
+    :param path: registry JSON file
+    :return: registry dict, a single English profile on the existing training set if the file is missing
+    """
+    if Path(path).exists():
+        with open(str(path)) as f:
+            return json.load(f)
+    return {"default": "default",
+            "profiles": {"default": {"model": USE_MODEL_URL, "train_meta": str(TRAIN_META_PATH),
+                                     "train_vecs": str(TRAIN_VECS_PATH)}},
+            "markets": {}}
+
+
+def profile_for_markets(markets, registry=None):
+    """
+    :param markets: market of each utterance, None where unknown
+    :param registry: registry dict, loaded from MODEL_REGISTRY_PATH if not given
+    :return: array of the profile name each utterance is routed to
+    """
+    registry = registry or load_model_registry()
+    routes = {market.lower(): profile for market, profile in registry.get("markets", {}).items()}
+    markets = pd.Series(markets, dtype=object).str.lower()
+    return np.asarray(markets.map(routes).fillna(registry["default"]), dtype=object)
+
+
+def _normalise(vecs):
+    vecs = np.asarray(vecs, dtype=np.float32)
+    norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+    return vecs / np.maximum(norms, 1e-12)
+
+
+class CentroidIndex:
+    """
+    Unit-length mean embedding of each FAQ of one profile, scored by cosine distance.
+    Novelty is the distance to the nearest centroid relative to the typical distance of that FAQ's own
+    training examples, negated so that, as with LOF, typical utterances score about -1 and novel ones lower.
+    """
+
+    def __init__(self, model, faq_ids, centroids, radius):
+        self.model = model
+        self.faq_ids = np.asarray(faq_ids)
+        self.centroids = _normalise(centroids)
+        self.radius = np.maximum(np.asarray(radius, dtype=np.float32), 1e-6)
+
+    @classmethod
+    def fit(cls, model, vecs, faq_ids):
+        """
+        :param model: embedding model the vectors come from
+        :param vecs: training vectors
+        :param faq_ids: FAQ of each training vector
+        :return: index of the per-FAQ centroids
+        """
+        vecs = _normalise(vecs)
+        labels, codes = np.unique(np.asarray(faq_ids).astype(str), return_inverse=True)
+        sums = np.zeros((len(labels), vecs.shape[1]), dtype=np.float64)
+        np.add.at(sums, codes, vecs)
+        centroids = _normalise(sums)
+        distances = 1 - np.einsum('ij,ij->i', vecs, centroids[codes])
+        order = np.argsort(codes, kind='mergesort')
+        groups = np.split(distances[order], np.flatnonzero(np.diff(codes[order])) + 1)
+        radius = np.array([np.median(group) for group in groups])
+        # single-example FAQs have no spread of their own
+        radius = np.where(radius > 0, radius, np.median(distances) if len(distances) else 1.)
+        return cls(model, labels, centroids, radius)
+
+    def score(self, vecs):
+        """
+        :param vecs: query vectors from the same model
+        :return: dataframe of nearest FAQ, cosine distance to its centroid and novelty score per query
+        """
+        vecs = _normalise(vecs)
+        nearest = np.empty(len(vecs), dtype=np.int64)
+        similarity = np.empty(len(vecs), dtype=np.float32)
+        for start in range(0, len(vecs), SCORE_CHUNK_SIZE):
+            sims = vecs[start:start + SCORE_CHUNK_SIZE] @ self.centroids.T
+            best = sims.argmax(axis=1)
+            nearest[start:start + SCORE_CHUNK_SIZE] = best
+            similarity[start:start + SCORE_CHUNK_SIZE] = sims[np.arange(len(sims)), best]
+        distance = 1 - similarity
+        return pd.DataFrame({'nearest faq': self.faq_ids[nearest], 'distance': distance,
+                             'score': -distance / self.radius[nearest]})
+
+
+def profile_version(profile):
+    """
+    :param profile: registry entry
+    :return: identifier that changes with the model or either training file
+    """
+    files = [profile["train_meta"], profile.get("train_vecs")]
+    parts = [profile["model"]] + [train_key(path) if path else None for path in files]
+    return hashlib.sha1(json.dumps(parts).encode("utf-8")).hexdigest()[:16]
+
+
+def load_training_data(name, profile, version):
+    """
+    :param name: profile name
+    :param profile: registry entry
+    :param version: profile_version of the entry
+    :return: training vectors and FAQ ids, the vectors cached as .npy
+    """
+    meta_path = Path(profile["train_meta"])
+    meta = read_upload(meta_path, meta_path.name, False)
+    vecs_file = profile.get("train_vecs")
+    if vecs_file:
+        # same id<TAB>v1,v2,... layout as TRAIN_VECS_PATH, converted once by app.novelty
+        vecs = load_train_vectors(Path(vecs_file))
+    else:
+        npy_path = CENTROID_DIR / name / (version + "-train.npy")
+        if not npy_path.exists():
+            embedded = embed(meta['question'].astype(str).tolist(), model_url=profile["model"])
+            _save_atomic(npy_path, lambda tmp: np.save(tmp, np.asarray(embedded, dtype=np.float32)))
+        vecs = np.load(str(npy_path), mmap_mode='r')
+    if len(vecs) != len(meta):
+        raise ValueError("Profile " + name + " has " + str(len(vecs)) + " training vectors for "
+                         + str(len(meta)) + " FAQ examples")
+    return vecs, meta['FAQ_id'].values
+
+
+def get_centroid_index(name, registry=None):
+    """
+    :param name: profile name
+    :param registry: registry dict, loaded from MODEL_REGISTRY_PATH if not given
+    :return: centroid index of the profile, loaded from disk if this version was computed before
+    """
+    registry = registry or load_model_registry()
+    profile = registry["profiles"][name]
+    version = profile_version(profile)
+    with _indexes_lock:
+        if (name, version) in _indexes:
+            return _indexes[(name, version)]
+        path = CENTROID_DIR / name / (version + "-centroids.npz")
+        if path.exists():
+            saved = np.load(str(path), allow_pickle=False)
+            index = CentroidIndex(profile["model"], saved['faq_ids'], saved['centroids'], saved['radius'])
+        else:
+            vecs, faq_ids = load_training_data(name, profile, version)
+            with span('centroids.fit', profile=name) as s:
+                s['rows'] = len(vecs)
+                index = CentroidIndex.fit(profile["model"], vecs, faq_ids)
+            _save_atomic(path, lambda tmp: np.savez(tmp, faq_ids=index.faq_ids.astype(str),
+                                                    centroids=index.centroids, radius=index.radius))
+        _indexes[(name, version)] = index
+        return index
+
+
+def score_by_market(texts, markets=None, registry=None):
+    """
+    :param texts: utterances
+    :param markets: market of each utterance, routed to its profile's model and centroids
+    :param registry: registry dict, loaded from MODEL_REGISTRY_PATH if not given
+    :return: dataframe of profile, nearest FAQ, cosine distance and novelty score in the order of texts
+    """
+    texts = pd.Series(list(texts), dtype=object)
+    registry = registry or load_model_registry()
+    markets = [None] * len(texts) if markets is None else list(markets)
+    profiles = profile_for_markets(markets, registry)
+    scores = pd.DataFrame({'profile': profiles, 'nearest faq': None, 'distance': np.nan, 'score': np.nan})
+    for name in pd.unique(profiles):
+        rows = np.flatnonzero(profiles == name)
+        index = get_centroid_index(name, registry)
+        with span('centroids.score', profile=name) as s:
+            s['rows'] = len(rows)
+            scored = index.score(embed(texts.iloc[rows].tolist(), model_url=index.model))
+        for column in ['nearest faq', 'distance', 'score']:
+            scores.loc[rows, column] = scored[column].values
+    scores['distance'] = scores['distance'].astype(np.float32)
+    scores['score'] = scores['score'].astype(np.float32)
+    return scores
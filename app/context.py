@@ -0,0 +1,184 @@
+import threading
+import pandas as pd
+from app.analysis import novel_df, confidence_over_time
+from app.cache import cached_faq_feedback, cached_message_analytics, cached_intent_rollup, sync_faq_feedback, \
+    sync_message_analytics, load_scored_novelty, save_scored_novelty, scored_novelty_parts, scored_novelty_version
+from app.metrics import span
+from app.rollups import aggregate_feedback, merge_rollup, market_summary, FEEDBACK_KEYS
+
+_MISSING = object()
+
+
+class DataContext:
+    """
+    Lazily loaded, memoised analytics data. Nothing is queried until an accessor is first called.
+    """
+
+    def __init__(self):
+        self._values = {}
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self._warm_thread = None
+        # parts of utterances scored through the API already merged into novel(), by name
+        self._scored_novel = {}
+        self._scored_version = None
+
+    def _get(self, key, loader):
+        """
+        :param key: name of the memoised value
+        :param loader: function computing the value on first access
+        :return: the memoised value
+        """
+        value = self._values.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        # concurrent callers of the same key wait for the first load instead of repeating it
+        with self._lock_for(key):
+            if key not in self._values:
+                with span('context.' + key):
+                    self._values[key] = loader()
+            return self._values[key]
+
+    def _lock_for(self, key):
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def invalidate(self, *keys):
+        """
+        :param keys: names of memoised values to recompute on next access, all values if none given
+        """
+        for key in keys or list(self._values):
+            self._values.pop(key, None)
+
+    def synced(self):
+        """
+        :return: number of new feedback and message rows pulled into the local cache
+        """
+        return self._get('synced', lambda: (sync_faq_feedback(), sync_message_analytics()))
+
+    def feedback(self):
+        """
+        :return: user utterances resulting in positive and negative feedback
+        """
+        self.synced()
+        return self._get('feedback', lambda: cached_faq_feedback(sync=False))
+
+    def something_else_triggers(self):
+        """
+        :return: user utterances that triggered a "something else" press
+        """
+        self.synced()
+        return self._get('something_else_triggers', lambda: cached_message_analytics(something_else=True, sync=False))
+
+    def all_messages(self):
+        """
+        :return: user utterances from message_analytics
+        """
+        self.synced()
+        return self._get('all_messages', lambda: cached_message_analytics(something_else=False, sync=False))
+
+    def novel(self):
+        """
+        :return: dataframe containing novelty scores of user feedback w/ metadata
+        """
+        self.load_scored()
+        return self._novel()
+
+    def _novel(self):
+        return self._get('novel', lambda: pd.concat([self._novel_batch()] + list(self._scored_novel.values()),
+                                                    ignore_index=True))
+
+    def _novel_batch(self):
+        pos_feedback, neg_feedback = self.feedback()
+        return self._get('novel_batch', lambda: novel_df(self.something_else_triggers(), pos_feedback, neg_feedback))
+
+    def append_novel(self, rows):
+        """
+        Persist newly scored utterances under CACHE_DIR, where every worker picks them up.
+        :param rows: dataframe of newly scored utterances with the columns of novel()
+        """
+        save_scored_novelty(rows)
+        self.load_scored()
+
+    def load_scored(self):
+        """
+        Merge parts of scored utterances written by any worker since the last call.
+        """
+        # the directory is only listed when a part was added or removed
+        if scored_novelty_version() == self._scored_version:
+            return
+        # same lock order as the feedback_rollup loader, so rows are counted exactly once
+        with self._lock_for('feedback_rollup'):
+            with self._lock_for('novel'):
+                version = scored_novelty_version()
+                parts = scored_novelty_parts()
+                new = [part for part in parts if part not in self._scored_novel]
+                try:
+                    loaded = load_scored_novelty(new)
+                except OSError:
+                    # removed by a compaction while reading, the next call sees the merged part
+                    return
+                kept = {part: self._scored_novel[part] for part in parts if part in self._scored_novel}
+                compacted = len(kept) < len(self._scored_novel)
+                self._scored_version = version
+                if not new and not compacted:
+                    return
+                kept.update(zip(new, loaded))
+                self._scored_novel = kept
+                self.invalidate('novel')
+            if compacted:
+                # rows of the removed parts are in a new part now, the rollup is recomputed
+                self.invalidate('feedback_rollup')
+            elif 'feedback_rollup' in self._values:
+                for rows in loaded:
+                    self._values['feedback_rollup'] = merge_rollup(self._values['feedback_rollup'],
+                                                                   aggregate_feedback(rows), FEEDBACK_KEYS)
+        self.invalidate('mkt_analysis')
+
+    def feedback_rollup(self):
+        """
+        :return: counts, novelty score sums and confidence sums per market and feedback type
+        """
+        self.load_scored()
+        return self._get('feedback_rollup', lambda: aggregate_feedback(self._novel()))
+
+    def intent_rollup(self):
+        """
+        :return: confidence aggregates per market, intent and day
+        """
+        self.synced()
+        return self._get('intent_rollup', lambda: cached_intent_rollup(sync=False))
+
+    def mkt_analysis(self):
+        """
+        :return: dataframe containing various analytics for each market
+        """
+        self.load_scored()
+        return self._get('mkt_analysis', lambda: market_summary(self.feedback_rollup()))
+
+    def time_series(self):
+        """
+        :return: dataframe containing average weekly confidence of the top intents
+        """
+        return self._get('time_series', lambda: confidence_over_time(self.intent_rollup()))
+
+    def warm(self, background=True):
+        """
+        :param background: load in a daemon thread and return immediately if true
+        :return: the warming thread if background, otherwise None
+        """
+        def load():
+            try:
+                self.mkt_analysis()
+                self.time_series()
+                print("Data context warmed")
+            except Exception as e:
+                print(e)
+
+        if not background:
+            load()
+            return None
+        if self._warm_thread is None or not self._warm_thread.is_alive():
+            self._warm_thread = threading.Thread(target=load, name='data-context-warm', daemon=True)
+            self._warm_thread.start()
+        return self._warm_thread
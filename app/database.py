@@ -1,59 +1,343 @@
 import mysql.connector
+import mysql.connector.pooling
+import numpy as np
 import pandas as pd
 import os
-from ast import literal_eval
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from dotenv import load_dotenv
+from pandas.api.types import union_categoricals
 from pathlib import Path
+from app.events import decode_user_events
+from app.metrics import registry, span
 
 
 load_dotenv(dotenv_path=Path("..") / ".env")
-mydb = mysql.connector.connect(
-    host=os.getenv("DB_HOST"),
-    user=os.getenv("DB_USER"),
-    db=os.getenv("DB_NAME"),
-    password=os.getenv("DB_PASS")
-)
-cursor = mydb.cursor()
 
+# "mysql", or "sqlite" to run against a local file with the same tables, e.g. for tests
+DB_BACKEND = os.getenv("DB_BACKEND", "mysql")
+DB_SQLITE_PATH = os.getenv("DB_SQLITE_PATH", "analytics.sqlite")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_RETRIES = int(os.getenv("DB_RETRIES", 3))
+DB_RETRY_DELAY = float(os.getenv("DB_RETRY_DELAY", 0.5))
+# rows pulled from the server per round trip when streaming message_analytics
+CHUNK_SIZE = int(os.getenv("DB_CHUNK_SIZE", 50000))
+SOMETHING_ELSE_INTENT = 'navigational:something_else'
+MESSAGE_COLUMNS = ['text', 'intent', 'confidence', 'market', 'ts_in_db', 'conversation_id']
+CATEGORY_COLUMNS = ['intent', 'market', 'conversation_id']
 
-def db_get_faq_feedback():
+
+def _string_dtype():
+    try:
+        return pd.StringDtype("pyarrow")
+    except (TypeError, ImportError, AttributeError):
+        # Arrow-backed strings need pandas >= 1.3 with pyarrow >= 1.0, plain object strings otherwise
+        return object
+
+
+STRING_DTYPE = _string_dtype()
+
+# errors worth retrying on a fresh connection, e.g. the server restarted, timed out or the pool was exhausted
+TRANSIENT_ERRORS = (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError,
+                    mysql.connector.errors.PoolError, sqlite3.OperationalError)
+
+
+def is_transient(error):
+    """
+    :param error: exception raised by a query
+    :return: true if the query is worth retrying, see TRANSIENT_ERRORS
+    """
+    if isinstance(error, sqlite3.OperationalError):
+        # missing tables and syntax errors are OperationalError too, only a locked database clears up
+        message = str(error).lower()
+        return 'locked' in message or 'busy' in message
+    return isinstance(error, TRANSIENT_ERRORS)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Created on first use, so the app starts even if the database is briefly unavailable.
+    :return: the shared MySQL connection pool
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = mysql.connector.pooling.MySQLConnectionPool(
+                pool_name="analytics",
+                pool_size=DB_POOL_SIZE,
+                host=os.getenv("DB_HOST"),
+                user=os.getenv("DB_USER"),
+                db=os.getenv("DB_NAME"),
+                password=os.getenv("DB_PASS"),
+                consume_results=True
+            )
+        return _pool
+
+
+def _connect():
+    if DB_BACKEND == 'sqlite':
+        return sqlite3.connect(DB_SQLITE_PATH, check_same_thread=False)
+    conn = get_pool().get_connection()
+    try:
+        # pooled connections may have been dropped by the server while idle, retrying is left to the caller
+        conn.ping(reconnect=True, attempts=1, delay=0)
+    except Exception:
+        conn.close()
+        raise
+    return conn
+
+
+@contextmanager
+def connection():
+    """
+    Connects once, callers retry the whole query, see _query.
+    :return: context manager lending a connection, returned to the pool on exit
     """
+    conn = _connect()
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def _sql(query):
+    # the queries are written with MySQL placeholders
+    return query.replace('%s', '?') if DB_BACKEND == 'sqlite' else query
+
+
+def _query(name, query, params=None):
+    """
+    Retried on a new connection if it fails with a transient error.
+    :param name: label of the query, recorded as the db.<name> metric
+    :param query: SQL with %s placeholders
+    :param params: query parameters
+    :return: dataframe of all result rows
+    """
+    for attempt in range(DB_RETRIES + 1):
+        start = time.perf_counter()
+        try:
+            with connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    cursor.execute(_sql(query), params or ())
+                    result = pd.DataFrame(cursor.fetchall(), columns=[i[0] for i in cursor.description])
+                finally:
+                    cursor.close()
+        except TRANSIENT_ERRORS as e:
+            registry.record('db.' + name, time.perf_counter() - start, error=True)
+            if attempt == DB_RETRIES or not is_transient(e):
+                raise
+            print("Query " + name + " failed, retrying: " + str(e))
+            time.sleep(DB_RETRY_DELAY * 2 ** attempt)
+            continue
+        registry.record('db.' + name, time.perf_counter() - start, len(result))
+        return result
+
+
+def db_get_faq_feedback_raw(since_id=None):
+    """
+    :param since_id: only return feedback with an id greater than this, if given
+    :return: raw rows from faq_feedback_multilg joined with their market
+    """
+    query = ("SELECT F.id, F.utterance, F.correct, F.faq_id, M.market "
+             "FROM faq_feedback_multilg F, markets M "
+             "WHERE F.market_id = M.market_id")
+    if since_id is None:
+        return _query('faq_feedback', query)
+    return _query('faq_feedback', query + " AND F.id > %s ORDER BY F.id", (since_id,))
+
+
+def split_feedback(result):
+    """
+    :param result: raw rows from faq_feedback_multilg
     :return: user utterances resulting in positive and negative feedback
     """
-    cursor.execute("SELECT F.id, F.utterance, F.correct, F.faq_id, M.market "
-                   "FROM faq_feedback_multilg F, markets M "
-                   "WHERE F.market_id = M.market_id")
-    result = pd.DataFrame(cursor.fetchall(), columns=[i[0] for i in cursor.description])
     pos_feedback = result[result['correct'] == 1][['utterance', 'market', 'faq_id']]
     neg_feedback = result[result['correct'] == -1][['utterance', 'market', 'faq_id']]
     return pos_feedback, neg_feedback
 
 
-def db_get_message_analytics(something_else):
+def db_get_faq_feedback():
+    """
+    :return: user utterances resulting in positive and negative feedback
+    """
+    return split_feedback(db_get_faq_feedback_raw())
+
+
+def previous_turns(result):
+    """
+    :param result: raw rows from message_analytics
+    :return: the message preceding each something else press within its conversation
     """
+    ordered = result.sort_values(['conversation_id', 'ts_in_db'], kind='mergesort')
+    same_conversation = (ordered['conversation_id'] == ordered['conversation_id'].shift(1)).values
+    is_trigger = (ordered['top_intent'] == SOMETHING_ELSE_INTENT).values
+    return ordered.iloc[np.flatnonzero(is_trigger & same_conversation) - 1]
+
+
+def parse_message_analytics(result, something_else):
+    """
+    :param result: raw rows from message_analytics
     :param something_else: return only something else triggers if true, otherwise return all text
-    :return: user utterances from message_analytics
+    :return: user utterances with parsed user_event fields
     """
-    cursor.execute("SELECT ts_in_db, top_intent, user_event, market, conversation_id "
-                   "FROM message_analytics MS "
-                   "LEFT JOIN  markets M ON MS.market_id = M.market_id")
-    result = pd.DataFrame(cursor.fetchall(), columns=[i[0] for i in cursor.description])
     if something_else:
-        something_else = result[result['top_intent'] == 'navigational:something_else']
-        idx_prev = something_else.index - 1
-        something_else_triggers = result.iloc[idx_prev, :]
-        text = something_else_triggers['user_event'].map(eval)
-        result = something_else_triggers
-    else:
-        user_event_list = result['user_event'].to_list()
-        user_event_list = str(user_event_list).replace("null", "123456")
-        result['user_event'] = literal_eval(user_event_list)
-        text = result['user_event'].map(eval)
-
-    text = text.apply(pd.Series)
+        result = previous_turns(result)
+
+    if result.empty:
+        return compact_messages(pd.DataFrame(columns=MESSAGE_COLUMNS))
+    with span('database.decode_user_events') as s:
+        s['rows'] = len(result)
+        text = decode_user_events(result['user_event'])
     text['market'] = result['market']
     text['ts_in_db'] = result['ts_in_db']
     text['conversation_id'] = result['conversation_id']
-    return text
+    return compact_messages(text)
+
+
+def compact_messages(messages):
+    """
+    :param messages: parsed user utterances
+    :return: MESSAGE_COLUMNS only, with categorical intent, market and conversation_id, float32 confidence,
+        datetime64 ts_in_db and Arrow-backed text where pandas supports it
+    """
+    return pd.DataFrame({
+        'text': messages['text'].astype(STRING_DTYPE),
+        'intent': messages['intent'].astype('category'),
+        'confidence': pd.to_numeric(messages['confidence']).astype(np.float32),
+        'market': messages['market'].astype('category'),
+        'ts_in_db': pd.to_datetime(messages['ts_in_db']),
+        'conversation_id': messages['conversation_id'].astype('category'),
+    }, index=messages.index)
+
 
+def _stream(name, query, params=None, chunk_size=CHUNK_SIZE):
+    """
+    Holds one pooled connection until the generator is exhausted or closed.
+    Connecting and executing are retried, a failure part way through is not since rows were already yielded.
+    """
+    for attempt in range(DB_RETRIES + 1):
+        start = time.perf_counter()
+        conn = stream = None
+        try:
+            conn = _connect()
+            stream = conn.cursor()
+            stream.execute(_sql(query), params or ())
+            break
+        except TRANSIENT_ERRORS as e:
+            if stream is not None:
+                stream.close()
+            if conn is not None:
+                conn.close()
+            registry.record('db.' + name, time.perf_counter() - start, error=True)
+            if attempt == DB_RETRIES or not is_transient(e):
+                raise
+            print("Query " + name + " failed, retrying: " + str(e))
+            time.sleep(DB_RETRY_DELAY * 2 ** attempt)
+    n_rows = 0
+    error = False
+    try:
+        columns = [i[0] for i in stream.description]
+        while True:
+            rows = stream.fetchmany(chunk_size)
+            if not rows:
+                break
+            n_rows += len(rows)
+            yield pd.DataFrame(rows, columns=columns)
+    except Exception:
+        error = True
+        raise
+    finally:
+        stream.close()
+        conn.close()
+        registry.record('db.' + name, time.perf_counter() - start, n_rows, error)
+
+
+def db_iter_message_analytics_raw(since=None, chunk_size=CHUNK_SIZE):
+    """
+    :param since: only return messages stored at or after this timestamp, if given
+    :param chunk_size: number of rows fetched from the server at a time
+    :return: generator of raw message_analytics frames ordered by ts_in_db, one per chunk
+    """
+    query = ("SELECT ts_in_db, top_intent, user_event, market, conversation_id "
+             "FROM message_analytics MS "
+             "LEFT JOIN  markets M ON MS.market_id = M.market_id")
+    if since is None:
+        return _stream('message_analytics', query + " ORDER BY MS.ts_in_db", chunk_size=chunk_size)
+    return _stream('message_analytics', query + " WHERE MS.ts_in_db >= %s ORDER BY MS.ts_in_db", (since,),
+                   chunk_size)
+
+
+def db_iter_something_else_triggers_raw(chunk_size=CHUNK_SIZE):
+    """
+    Only conversations containing a something else press are windowed, see sql/indexes.sql.
+    :param chunk_size: number of rows fetched from the server at a time
+    :return: generator of raw frames of the message preceding each something else press in its conversation
+    """
+    query = ("SELECT T.prev_ts AS ts_in_db, T.prev_user_event AS user_event, M.market, T.conversation_id "
+             "FROM ("
+             "  SELECT MS.market_id, MS.conversation_id, MS.top_intent, "
+             "    LAG(MS.user_event) OVER w AS prev_user_event, "
+             "    LAG(MS.ts_in_db) OVER w AS prev_ts "
+             "  FROM message_analytics MS "
+             "  WHERE MS.conversation_id IN "
+             "    (SELECT conversation_id FROM message_analytics WHERE top_intent = %s) "
+             "  WINDOW w AS (PARTITION BY MS.conversation_id ORDER BY MS.ts_in_db)"
+             ") T "
+             "LEFT JOIN markets M ON T.market_id = M.market_id "
+             "WHERE T.top_intent = %s AND T.prev_ts IS NOT NULL")
+    return _stream('something_else_triggers', query, (SOMETHING_ELSE_INTENT, SOMETHING_ELSE_INTENT), chunk_size)
 
+
+def iter_parsed_message_analytics(chunks):
+    """
+    :param chunks: iterable of raw message_analytics frames
+    :return: generator of parsed user utterance frames, one per chunk
+    """
+    for chunk in chunks:
+        parsed = parse_message_analytics(chunk, something_else=False)
+        if len(parsed):
+            yield parsed.reset_index(drop=True)
+
+
+def db_iter_message_analytics(something_else, chunk_size=CHUNK_SIZE):
+    """
+    :param something_else: return only something else triggers if true, otherwise return all text
+    :param chunk_size: number of rows fetched from the server at a time
+    :return: generator of parsed user utterance frames, one per chunk
+    """
+    if something_else:
+        return iter_parsed_message_analytics(db_iter_something_else_triggers_raw(chunk_size))
+    return iter_parsed_message_analytics(db_iter_message_analytics_raw(chunk_size=chunk_size))
+
+
+def db_get_message_analytics(something_else, chunk_size=CHUNK_SIZE):
+    """
+    :param something_else: return only something else triggers if true, otherwise return all text
+    :param chunk_size: number of rows fetched from the server at a time
+    :return: user utterances from message_analytics
+    """
+    return concat_parsed(db_iter_message_analytics(something_else, chunk_size))
+
+
+def concat_parsed(parsed_chunks):
+    """
+    :param parsed_chunks: iterable of parsed user utterance frames
+    :return: single frame of user utterances
+    """
+    chunks = list(parsed_chunks)
+    if not chunks:
+        return compact_messages(pd.DataFrame(columns=MESSAGE_COLUMNS))
+    # chunks only stay categorical when concatenated if their categories are identical
+    for column in CATEGORY_COLUMNS:
+        # all-null chunks, e.g. markets missing from the LEFT JOIN, get object rather than string categories
+        categories = union_categoricals([chunk[column].cat.set_categories(
+            chunk[column].cat.categories.astype(object)) for chunk in chunks]).categories
+        chunks = [chunk.assign(**{column: chunk[column].cat.set_categories(categories)}) for chunk in chunks]
+    return pd.concat(chunks, ignore_index=True)
@@ -0,0 +1,110 @@
+import os
+import re
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from app.figures import ResultCache
+
+# uploaded datasets and their analysis results, addressed by a hash of the uploaded files
+DATASET_DIR = Path(os.getenv("DATASET_DIR", Path(os.getenv("CACHE_DIR", "cache")) / "datasets"))
+
+# datasets kept open per worker, the least recently used are dropped
+DATASET_CACHE_SIZE = int(os.getenv("DATASET_CACHE_SIZE", 4))
+
+_loaded = ResultCache(maxsize=DATASET_CACHE_SIZE)
+
+
+def dataset_path(key):
+    """
+    :param key: content hash of the uploaded files
+    :return: directory holding the dataset
+    """
+    # keys come back from the browser session, so they must not reach outside DATASET_DIR
+    if not is_dataset_key(key):
+        raise ValueError("Invalid dataset key")
+    return DATASET_DIR / key
+
+
+def is_dataset_key(key):
+    """
+    :param key: candidate dataset key
+    :return: true if the key has the form of a content hash, see app.figures.content_key
+    """
+    return isinstance(key, str) and re.fullmatch(r'[0-9a-f]{40}', key) is not None
+
+
+def has_dataset(key):
+    """
+    :param key: content hash of the uploaded files
+    :return: true if the dataset has been analysed and stored completely
+    """
+    return is_dataset_key(key) and (dataset_path(key) / "complete").exists()
+
+
+def save_dataset(key, scaled_data, embedding_df, outliers=None, outliers_name="outliers"):
+    """
+    :param key: content hash of the uploaded files
+    :param scaled_data: scaled vector embeddings
+    :param embedding_df: 2D UMAP embedding w/ metadata
+    :param outliers: outlier results, if computed
+    :param outliers_name: name to save the outlier results under
+    """
+    path = dataset_path(key)
+    if has_dataset(key):
+        return
+    DATASET_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = Path(tempfile.mkdtemp(dir=str(DATASET_DIR), prefix=key + "."))
+    np.save(str(tmp / "scaled.npy"), np.asarray(scaled_data, dtype=np.float32))
+    _to_parquet(embedding_df, tmp / "embedding.parquet")
+    if outliers is not None:
+        _to_parquet(outliers, tmp / (outliers_name + ".parquet"))
+    (tmp / "complete").touch()
+    try:
+        os.rename(str(tmp), str(path))
+    except OSError:
+        # stored concurrently by another worker with the same upload
+        shutil.rmtree(str(tmp), ignore_errors=True)
+
+
+def _to_parquet(df, path):
+    df = df.copy()
+    df.columns = [str(column) for column in df.columns]
+    df.to_parquet(str(path), engine='pyarrow', index=False)
+
+
+def load_dataset(key):
+    """
+    :param key: content hash of the uploaded files
+    :return: memory-mapped scaled vector embeddings and 2D UMAP embedding w/ metadata
+    """
+    path = dataset_path(key)
+    # read-only mapping, so workers on one host share the pages of the same upload
+    return _loaded.get_or_compute(key, lambda: (np.load(str(path / "scaled.npy"), mmap_mode='r'),
+                                                pd.read_parquet(str(path / "embedding.parquet"), engine='pyarrow')))
+
+
+def load_outliers(key, name="outliers"):
+    """
+    :param key: content hash of the uploaded files
+    :param name: name the outlier results were saved under
+    :return: stored outlier results, or None
+    """
+    path = dataset_path(key) / (name + ".parquet")
+    if not path.exists():
+        return None
+    return pd.read_parquet(str(path), engine='pyarrow')
+
+
+def save_outliers(key, outliers, name="outliers"):
+    """
+    :param key: content hash of the uploaded files
+    :param outliers: outlier results
+    :param name: name to save the outlier results under, e.g. including the LOF settings
+    """
+    path = dataset_path(key) / (name + ".parquet")
+    fd, tmp = tempfile.mkstemp(dir=str(path.parent), suffix=".parquet")
+    os.close(fd)
+    _to_parquet(outliers, Path(tmp))
+    os.replace(tmp, str(path))
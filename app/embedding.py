@@ -0,0 +1,209 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import unicodedata
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import tensorflow_hub as hub
+from app.metrics import span
+
+USE_MODEL_URL = "https://tfhub.dev/google/universal-sentence-encoder/4"
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 256))
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", 2))
+EMBEDDING_DIR = Path(os.getenv("EMBEDDING_DIR", Path(os.getenv("CACHE_DIR", "cache")) / "embeddings"))
+
+_models = {}
+_models_lock = threading.Lock()
+
+
+def get_model(model_url=USE_MODEL_URL):
+    """
+    :param model_url: tensorflow hub handle of the sentence encoder
+    :return: the encoder, loaded once per process
+    """
+    with _models_lock:
+        if model_url not in _models:
+            print("Loading " + model_url)
+            _models[model_url] = hub.load(model_url)
+        return _models[model_url]
+
+
+def normalise_text(text):
+    """
+    :param text: raw utterance
+    :return: utterance in NFC form with whitespace collapsed
+    """
+    return " ".join(unicodedata.normalize("NFC", str(text)).split())
+
+
+def text_key(text, model_id):
+    """
+    :param text: normalised utterance
+    :param model_id: identifier of the model producing the embedding
+    :return: 20 byte content hash of the text and model
+    """
+    return hashlib.sha1(model_id.encode("utf-8") + b"\0" + text.encode("utf-8")).digest()
+
+
+class EmbeddingStore:
+    """
+    Append-only on-disk store of float32 embeddings for one model, addressed by text hash.
+    Records are (key, vector) pairs in a single file which is memory-mapped for reads.
+    """
+
+    def __init__(self, model_id, root=EMBEDDING_DIR):
+        self.model_id = model_id
+        self.path = Path(root) / hashlib.sha1(model_id.encode("utf-8")).hexdigest()[:16]
+        self.records_path = self.path / "records.bin"
+        self.meta_path = self.path / "meta.json"
+        self._lock = threading.Lock()
+        self._dtype = None
+        self._records = None
+        self._index = {}
+        if self.meta_path.exists():
+            with open(self.meta_path) as f:
+                self._set_dim(json.load(f)["dim"])
+
+    def _set_dim(self, dim):
+        # raw bytes, "S20" would strip the trailing zero bytes of a digest when read back
+        self._dtype = np.dtype([("key", "V20"), ("vec", "<f4", (dim,))])
+
+    def _create(self, dim):
+        self.path.mkdir(parents=True, exist_ok=True)
+        with open(self.meta_path, "w") as f:
+            json.dump({"model_id": self.model_id, "dim": int(dim)}, f)
+        self._set_dim(dim)
+
+    def _refresh(self):
+        # another process may have appended records since the file was mapped
+        if self._dtype is None or not self.records_path.exists():
+            return
+        num_records = self.records_path.stat().st_size // self._dtype.itemsize
+        if self._records is not None and len(self._records) == num_records:
+            return
+        if num_records == 0:
+            return
+        self._records = np.memmap(self.records_path, dtype=self._dtype, mode="r", shape=(num_records,))
+        for row in range(len(self._index), num_records):
+            self._index.setdefault(self._records["key"][row].tobytes(), row)
+
+    def lookup(self, keys):
+        """
+        :param keys: text hashes
+        :return: row of each key in the store, -1 if missing
+        """
+        with self._lock:
+            rows = np.array([self._index.get(key, -1) for key in keys], dtype=np.int64)
+            if (rows < 0).any():
+                self._refresh()
+                rows = np.array([self._index.get(key, -1) for key in keys], dtype=np.int64)
+            return rows
+
+    def vectors(self, rows):
+        """
+        :param rows: rows returned by lookup
+        :return: float32 matrix of the stored vectors
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        if (rows < 0).any():
+            raise ValueError("Cannot read vectors of keys missing from the store")
+        if len(rows) == 0:
+            dim = self._dtype["vec"].shape[0] if self._dtype is not None else 0
+            return np.empty((0, dim), dtype=np.float32)
+        return np.asarray(self._records["vec"][rows], dtype=np.float32)
+
+    def add(self, keys, vecs):
+        """
+        :param keys: text hashes
+        :param vecs: corresponding embeddings
+        """
+        vecs = np.asarray(vecs, dtype=np.float32)
+        with self._lock:
+            if self._dtype is None:
+                self._create(vecs.shape[1])
+            records = np.empty(len(keys), dtype=self._dtype)
+            records["key"] = keys
+            records["vec"] = vecs
+            # a single appending write keeps keys and vectors aligned between processes
+            with open(self.records_path, "ab") as f:
+                f.write(records.tobytes())
+            self._refresh()
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(model_id=USE_MODEL_URL):
+    """
+    :param model_id: identifier of the model producing the embeddings
+    :return: the embedding store of the model, opened once per process
+    """
+    with _stores_lock:
+        if model_id not in _stores:
+            _stores[model_id] = EmbeddingStore(model_id)
+        return _stores[model_id]
+
+
+def embed_batches(texts, model_url=USE_MODEL_URL, batch_size=EMBED_BATCH_SIZE, workers=EMBED_WORKERS):
+    """
+    :param texts: list of utterances
+    :param model_url: tensorflow hub handle of the sentence encoder
+    :param batch_size: number of utterances per model call
+    :param workers: number of batches in flight at once
+    :return: float32 matrix of embeddings in the order of texts
+    """
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32)
+    model = get_model(model_url)
+    # similar lengths in one batch keep padding low
+    order = np.argsort([len(text) for text in texts], kind="stable")
+    batches = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+    def run(idx):
+        return idx, model([texts[i] for i in idx]).numpy().astype(np.float32, copy=False)
+
+    start = time.perf_counter()
+    vecs = None
+    # the encoder releases the GIL, so several batches tokenise and run concurrently
+    with span('embedding.model', batches=len(batches)) as s, ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        s['rows'] = len(texts)
+        for idx, batch_vecs in pool.map(run, batches):
+            if vecs is None:
+                vecs = np.empty((len(texts), batch_vecs.shape[1]), dtype=np.float32)
+            vecs[idx] = batch_vecs
+    elapsed = time.perf_counter() - start
+    print("Embedded {} utterances in {:.1f}s ({:.0f} utterances/s)".format(
+        len(texts), elapsed, len(texts) / max(elapsed, 1e-9)))
+    return vecs
+
+
+def embed(texts, model_url=USE_MODEL_URL, batch_size=EMBED_BATCH_SIZE, workers=EMBED_WORKERS):
+    """
+    :param texts: iterable of raw utterances
+    :param model_url: tensorflow hub handle of the sentence encoder
+    :param batch_size: number of utterances per model call
+    :param workers: number of batches in flight at once
+    :return: float32 matrix of embeddings, only utterances not seen before are run through the model
+    """
+    with span('embedding.embed') as s:
+        texts = [normalise_text(text) for text in texts]
+        keys = [text_key(text, model_url) for text in texts]
+        store = get_store(model_url)
+        rows = store.lookup(keys)
+        s['rows'] = len(texts)
+
+        missing = {}
+        for text, key, row in zip(texts, keys, rows):
+            if row < 0:
+                missing.setdefault(key, text)
+        s['new'] = len(missing)
+        if missing:
+            print("Embedding " + str(len(missing)) + " new utterances")
+            vecs = embed_batches(list(missing.values()), model_url, batch_size, workers)
+            store.add(list(missing.keys()), vecs)
+            rows = store.lookup(keys)
+        return store.vectors(rows)
@@ -0,0 +1,61 @@
+import numpy as np
+import orjson
+import pandas as pd
+
+
+def decode_json_column(values):
+    """
+    :param values: sequence of JSON object strings (str, bytes or None)
+    :return: list of decoded dicts, empty for missing or non-object values
+    """
+    parts = []
+    for value in values:
+        if value is None or (isinstance(value, float) and np.isnan(value)):
+            parts.append(b'null')
+        elif isinstance(value, str):
+            parts.append(value.encode('utf-8'))
+        else:
+            parts.append(bytes(value))
+    try:
+        # one parser call over the whole column instead of one per row
+        decoded = orjson.loads(b'[' + b','.join(parts) + b']')
+    except orjson.JSONDecodeError:
+        decoded = None
+    if decoded is None or len(decoded) != len(parts):
+        # an empty or malformed value, e.g. "" or "1,2", must neither fail nor shift the whole chunk
+        decoded = [_loads_or_none(part) for part in parts]
+    return [d if isinstance(d, dict) else {} for d in decoded]
+
+
+def _loads_or_none(part):
+    try:
+        return orjson.loads(part)
+    except orjson.JSONDecodeError:
+        return None
+
+
+def decode_user_events(user_events):
+    """
+    :param user_events: series of user_event JSON strings
+    :return: dataframe with one column per user_event field, top_intent split into categorical intent and
+        float32 confidence
+    """
+    records = decode_json_column(user_events.to_list())
+    top_intents = [record.pop('top_intent', None) for record in records]
+    decoded = pd.DataFrame.from_records(records, index=user_events.index)
+    if 'text' not in decoded.columns:
+        decoded['text'] = None
+
+    intents = []
+    confidences = np.full(len(top_intents), np.nan)
+    for i, top_intent in enumerate(top_intents):
+        if isinstance(top_intent, dict):
+            intents.append(top_intent.get('intent'))
+            confidence = top_intent.get('confidence')
+            if confidence is not None:
+                confidences[i] = confidence
+        else:
+            intents.append(None)
+    decoded['intent'] = pd.Series(pd.Categorical(intents), index=user_events.index)
+    decoded['confidence'] = pd.Series(confidences.astype(np.float32), index=user_events.index)
+    return decoded
@@ -0,0 +1,101 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+import numpy as np
+
+# scatter plots above this many points are drawn with WebGL and thinned to MAX_POINTS
+WEBGL_THRESHOLD = int(os.getenv("WEBGL_THRESHOLD", 5000))
+MAX_POINTS = int(os.getenv("MAX_POINTS", 50000))
+
+
+def content_key(*contents):
+    """
+    :param contents: uploaded file contents as bytes, or paths of files to read
+    :return: hash identifying the uploaded dataset
+    """
+    digest = hashlib.sha1()
+    for content in contents:
+        if isinstance(content, (str, Path)):
+            with open(str(content), 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+        else:
+            digest.update(content)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Small thread-safe LRU cache of computed results and figures.
+    """
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key, compute):
+        """
+        :param key: hashable key, e.g. (kind, dataset key, params)
+        :param compute: function computing the value on a miss
+        :return: the cached or newly computed value
+        """
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+        value = compute()
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+        return value
+
+
+results = ResultCache()
+
+
+def downsample(df, max_points=MAX_POINTS, x='x', y='y', bins=256, keep=None, seed=0):
+    """
+    Thin dense regions of a scatter plot while keeping sparse regions intact.
+    :param df: dataframe of points
+    :param max_points: number of points to keep at most, besides the kept ones
+    :param x: column of x-coords
+    :param y: column of y-coords
+    :param bins: grid resolution per axis
+    :param keep: boolean mask of points that are always kept, e.g. outliers
+    :param seed: random seed for choosing points within a cell
+    :return: subset of df
+    """
+    if len(df) <= max_points:
+        return df
+    xs = df[x].values.astype(np.float64)
+    ys = df[y].values.astype(np.float64)
+    cx = np.clip(((xs - xs.min()) / (np.ptp(xs) or 1) * bins).astype(np.int64), 0, bins - 1)
+    cy = np.clip(((ys - ys.min()) / (np.ptp(ys) or 1) * bins).astype(np.int64), 0, bins - 1)
+    cells = cx * bins + cy
+
+    # random rank of each point within its cell
+    order = np.random.RandomState(seed).permutation(len(df))
+    _, inverse, counts = np.unique(cells[order], return_inverse=True, return_counts=True)
+    first = np.argsort(inverse, kind='stable')
+    rank_sorted = np.arange(len(df)) - np.repeat(np.cumsum(counts) - counts, counts)
+    rank = np.empty(len(df), dtype=np.int64)
+    rank[order[first]] = rank_sorted
+
+    # largest per-cell cap that fits in max_points
+    lo, hi = 1, int(counts.max())
+    while lo < hi:
+        cap = (lo + hi + 1) // 2
+        if np.minimum(counts, cap).sum() <= max_points:
+            lo = cap
+        else:
+            hi = cap - 1
+    mask = rank < lo
+    if keep is not None:
+        mask |= np.asarray(keep, dtype=bool)
+    return df[mask]
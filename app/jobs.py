@@ -0,0 +1,277 @@
+import atexit
+import json
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+import uuid
+from pathlib import Path
+from queue import Empty
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))
+# status and cancel requests of every job, so any server worker can poll or cancel it
+JOB_DIR = Path(os.getenv("JOB_DIR", Path(os.getenv("CACHE_DIR", "cache")) / "jobs"))
+# finished jobs are forgotten after this many seconds
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", 3600))
+# a queued or running job whose status was not written for this long lost its server
+JOB_STALE_SECONDS = 60.
+JOB_HEARTBEAT_SECONDS = 10.
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+def _run_in_worker(queue, fn, args):
+    def progress(fraction, message=''):
+        queue.put(('progress', (fraction, message)))
+
+    try:
+        queue.put(('done', fn(*args, progress=progress)))
+    except Exception:
+        queue.put(('error', traceback.format_exc()))
+
+
+class Job:
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.state = QUEUED
+        self.progress = 0.
+        self.message = 'Waiting for a free worker'
+        self.result = None
+        self.error = None
+        self.started = None
+        self.finished = None
+        self.process = None
+        self.key = None
+        self.updated = None
+
+    def to_dict(self):
+        return {'id': self.id, 'name': self.name, 'key': self.key, 'state': self.state, 'progress': self.progress,
+                'message': self.message, 'error': self.error, 'updated': self.updated}
+
+
+def status_path(job_id):
+    return JOB_DIR / (job_id + ".json")
+
+
+def cancel_path(job_id):
+    return JOB_DIR / (job_id + ".cancel")
+
+
+def _valid_id(job_id):
+    return isinstance(job_id, str) and len(job_id) == 32 and all(c in '0123456789abcdef' for c in job_id)
+
+
+def read_status(job_id):
+    """
+    :param job_id: id returned by submit, in this or another server process
+    :return: last status written for the job, None if unknown
+    """
+    if not _valid_id(job_id):
+        return None
+    try:
+        with open(status_path(job_id)) as f:
+            status = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if status['state'] in (QUEUED, RUNNING) and time.time() - status['updated'] > JOB_STALE_SECONDS:
+        status.update(state=FAILED, error='The server running the job stopped')
+    return status
+
+
+class JobManager:
+    """
+    Runs long analysis functions in separate processes, at most max_workers at a time.
+    Functions are called as fn(*args, progress=callback) and report progress with callback(fraction, message).
+    """
+
+    def __init__(self, max_workers=JOB_WORKERS):
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(max_workers)
+        # spawned workers do not inherit the server's threads or loaded models
+        self._mp = multiprocessing.get_context('spawn')
+        atexit.register(self.shutdown)
+
+    def submit(self, fn, *args, name=None, key=None):
+        """
+        :param fn: picklable module-level function to run
+        :param args: picklable arguments of fn
+        :param name: label of the job
+        :param key: identifier of the work, a queued or running job with the same key is reused
+        :return: id of the queued job
+        """
+        job = Job(name or fn.__name__)
+        job.key = key
+        self.prune()
+        with self._lock:
+            if key is not None:
+                for other in self._jobs.values():
+                    if other.key == key and other.state in (QUEUED, RUNNING):
+                        return other.id
+            self._jobs[job.id] = job
+        self._write_status(job)
+        threading.Thread(target=self._run, args=(job, fn, args), name='job-' + job.id, daemon=True).start()
+        return job.id
+
+    def _write_status(self, job):
+        job.updated = time.time()
+        JOB_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = JOB_DIR / (job.id + ".json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(job.to_dict(), f)
+        os.replace(tmp, status_path(job.id))
+
+    def _cancel_requested(self, job):
+        # cancel requests from other server processes arrive as a file
+        if job.state in (QUEUED, RUNNING) and cancel_path(job.id).exists():
+            self.cancel(job.id)
+        return job.state == CANCELLED
+
+    def _run(self, job, fn, args):
+        try:
+            self._monitor(job, fn, args)
+        finally:
+            if job.finished is None:
+                job.finished = time.time()
+            self._write_status(job)
+
+    def _monitor(self, job, fn, args):
+        # queued jobs keep their status fresh too, so other processes do not take them for lost
+        while not self._slots.acquire(timeout=JOB_HEARTBEAT_SECONDS):
+            if self._cancel_requested(job):
+                return
+            self._write_status(job)
+        try:
+            if self._cancel_requested(job):
+                return
+            queue = self._mp.Queue()
+            # not daemonic, so jobs can start their own process pools, see app.neighbors.partitioned_lof
+            job.process = self._mp.Process(target=_run_in_worker, args=(queue, fn, args))
+            job.state = RUNNING
+            job.message = 'Starting'
+            job.started = time.time()
+            job.process.start()
+            self._write_status(job)
+            while True:
+                self._cancel_requested(job)
+                try:
+                    kind, payload = queue.get(timeout=0.5)
+                except Empty:
+                    if time.time() - job.updated > JOB_HEARTBEAT_SECONDS:
+                        self._write_status(job)
+                    if not job.process.is_alive():
+                        if job.state == RUNNING:
+                            job.state = FAILED
+                            job.error = 'Worker exited with code ' + str(job.process.exitcode)
+                        break
+                    continue
+                if job.state == CANCELLED:
+                    continue
+                if kind == 'progress':
+                    job.progress, job.message = payload
+                    self._write_status(job)
+                elif kind == 'done':
+                    job.result = payload
+                    job.progress = 1.
+                    job.message = 'Done'
+                    job.state = DONE
+                    break
+                else:
+                    job.error = payload
+                    job.state = FAILED
+                    break
+            job.process.join()
+            job.finished = time.time()
+            if job.error:
+                print(job.error)
+        finally:
+            self._slots.release()
+
+    def get(self, job_id):
+        """
+        :param job_id: id returned by submit
+        :return: the job, or None if unknown
+        """
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def status(self, job_id):
+        """
+        :param job_id: id returned by submit, in this or another server process
+        :return: dict of state, progress and message of the job
+        """
+        job = self.get(job_id)
+        status = job.to_dict() if job is not None else read_status(job_id)
+        if status is None:
+            return {'id': job_id, 'state': None, 'progress': 0., 'message': 'Unknown job'}
+        return status
+
+    def cancel(self, job_id):
+        """
+        :param job_id: id returned by submit, in this or another server process
+        :return: true if the job was queued or running and is now cancelled, or its cancellation was requested
+        """
+        job = self.get(job_id)
+        if job is None:
+            status = read_status(job_id)
+            if status is None or status['state'] not in (QUEUED, RUNNING):
+                return False
+            # picked up by the server process running the job
+            cancel_path(job_id).touch()
+            return True
+        if job.state not in (QUEUED, RUNNING):
+            return False
+        job.state = CANCELLED
+        job.message = 'Cancelled'
+        if job.process is not None and job.process.is_alive():
+            job.process.terminate()
+        self._write_status(job)
+        return True
+
+    def prune(self, retention=JOB_RETENTION):
+        """
+        Forgets jobs finished more than retention seconds ago, including their files from any server process.
+        :param retention: seconds a finished job is kept
+        """
+        cutoff = time.time() - retention
+        with self._lock:
+            for job_id in [job_id for job_id, job in self._jobs.items()
+                           if job.finished is not None and job.finished < cutoff]:
+                del self._jobs[job_id]
+            active = set(self._jobs)
+        if not JOB_DIR.exists():
+            return
+        for path in JOB_DIR.iterdir():
+            job_id = path.name.split('.', 1)[0]
+            try:
+                if job_id not in active and path.stat().st_mtime < cutoff:
+                    path.unlink()
+            except OSError:
+                pass
+
+    def shutdown(self):
+        """
+        Cancels all queued and running jobs, called when the server exits.
+        """
+        with self._lock:
+            job_ids = list(self._jobs)
+        for job_id in job_ids:
+            self.cancel(job_id)
+
+    def pop_result(self, job_id):
+        """
+        :param job_id: id of a finished job
+        :return: result of the job, which is then forgotten
+        """
+        with self._lock:
+            job = self._jobs.pop(job_id, None)
+        return job.result if job is not None else None
+
+
+jobs = JobManager()
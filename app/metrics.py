@@ -0,0 +1,188 @@
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+import numpy as np
+
+# off by default, a path appends one JSON line per span to that file, "-" prints them to stdout
+METRICS_LOG = os.getenv("METRICS_LOG", "")
+# spans shorter than this are aggregated but not logged, unless they failed
+METRICS_LOG_MIN_MS = float(os.getenv("METRICS_LOG_MIN_MS", 1))
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def rss_bytes():
+    """
+    :return: resident memory of this process in bytes, 0 where it cannot be read
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        # peak rather than current, but still shows stages that grow memory
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except ImportError:
+        return 0
+
+
+class LatencyTracker:
+    """
+    Rolling window of request latencies.
+    """
+
+    def __init__(self, window=1000):
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def record(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+            self.count += 1
+
+    def summary(self):
+        """
+        :return: dict of request count and p50 / p99 latency in milliseconds over the window
+        """
+        with self._lock:
+            latencies = np.array(self._latencies)
+        if not len(latencies):
+            return {"count": self.count, "p50_ms": None, "p99_ms": None}
+        return {"count": self.count,
+                "p50_ms": float(np.percentile(latencies, 50) * 1000),
+                "p99_ms": float(np.percentile(latencies, 99) * 1000)}
+
+
+class SpanStats(LatencyTracker):
+    """
+    Latencies of one named stage plus totals of time, rows, errors and memory growth.
+    """
+
+    def __init__(self, window=1000):
+        super().__init__(window)
+        self.total_s = 0.
+        self.max_s = 0.
+        self.rows = 0
+        self.errors = 0
+        self.max_rss_delta = 0
+
+    def add(self, seconds, rows=0, error=False, rss_delta=0):
+        self.record(seconds)
+        with self._lock:
+            self.total_s += seconds
+            self.max_s = max(self.max_s, seconds)
+            self.rows += rows
+            self.errors += int(error)
+            self.max_rss_delta = max(self.max_rss_delta, rss_delta)
+
+    def summary(self):
+        summary = super().summary()
+        summary.update({"total_s": self.total_s, "max_ms": self.max_s * 1000, "rows": self.rows,
+                        "errors": self.errors, "max_rss_delta_mb": self.max_rss_delta / 2 ** 20})
+        return summary
+
+
+class Registry:
+    """
+    Spans recorded in this process, by name.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._spans = {}
+        self._log_lock = threading.Lock()
+        self._local = threading.local()
+
+    def stats(self, name):
+        with self._lock:
+            if name not in self._spans:
+                self._spans[name] = SpanStats()
+            return self._spans[name]
+
+    def record(self, name, seconds, rows=0, error=False, rss_delta=0, **fields):
+        """
+        :param name: stage, e.g. "db.faq_feedback" or "callback.render_tab"
+        :param seconds: wall time of the stage
+        :param rows: number of rows the stage handled, if known
+        :param error: true if the stage raised
+        :param rss_delta: growth of resident memory during the stage in bytes
+        :param fields: extra values for the log line
+        """
+        self.stats(name).add(seconds, rows, error, rss_delta)
+        if METRICS_LOG and (error or seconds * 1000 >= METRICS_LOG_MIN_MS):
+            stack = getattr(self._local, 'stack', [])
+            self._log(dict({'ts': time.time(), 'span': name, 'parent': stack[-1] if stack else None,
+                            'ms': round(seconds * 1000, 3), 'rows': rows, 'error': error,
+                            'rss_delta_mb': round(rss_delta / 2 ** 20, 3), 'pid': os.getpid()}, **fields))
+
+    def _log(self, entry):
+        line = json.dumps(entry, default=str)
+        with self._log_lock:
+            if METRICS_LOG == '-':
+                print(line)
+            else:
+                with open(METRICS_LOG, 'a') as f:
+                    f.write(line + '\n')
+
+    @contextmanager
+    def span(self, name, **fields):
+        """
+        Times the block and records it under name. Assign span['rows'] inside the block to record a row count.
+        :param name: stage, e.g. "analysis.umap"
+        :param fields: extra values for the log line
+        :return: context manager yielding a dict for rows and further fields
+        """
+        info = dict({'rows': 0}, **fields)
+        stack = self._local.__dict__.setdefault('stack', [])
+        rss = rss_bytes()
+        start = time.perf_counter()
+        error = False
+        stack.append(name)
+        try:
+            yield info
+        except Exception:
+            error = True
+            raise
+        finally:
+            stack.pop()
+            rows = info.pop('rows')
+            self.record(name, time.perf_counter() - start, rows, error, rss_bytes() - rss, **info)
+
+    def timed(self, name=None):
+        """
+        :param name: stage, defaults to module.function
+        :return: decorator recording a span around every call
+        """
+        def decorator(fn):
+            span_name = name or fn.__module__.split('.')[-1] + '.' + fn.__name__
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.span(span_name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        """
+        :return: dict of span name to its summary, e.g. for the /metrics endpoint
+        """
+        with self._lock:
+            spans = dict(self._spans)
+        return {name: stats.summary() for name, stats in sorted(spans.items())}
+
+    def reset(self):
+        with self._lock:
+            self._spans.clear()
+
+
+registry = Registry()
+span = registry.span
+timed = registry.timed
@@ -0,0 +1,276 @@
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from scipy.stats import spearmanr
+from sklearn.neighbors import LocalOutlierFactor, NearestNeighbors
+
+# "exact" uses sklearn's LocalOutlierFactor, "hnsw" computes LOF from an approximate hnswlib graph
+LOF_BACKEND = os.getenv("LOF_BACKEND", "exact")
+# "global" fits one LOF on all uploaded vectors, "faq" or "faq_market" fit one per partition in parallel
+OUTLIER_PARTITION = os.getenv("OUTLIER_PARTITION", "global")
+LOF_WORKERS = int(os.getenv("LOF_WORKERS", os.cpu_count() or 1))
+
+
+class ExactIndex:
+    """
+    Exact k-nearest-neighbour search with sklearn.
+    """
+
+    def fit(self, X):
+        self._nn = NearestNeighbors().fit(X)
+        return self
+
+    def query(self, X, k):
+        """
+        :param X: query vectors
+        :param k: number of neighbours
+        :return: euclidean distances and indices of the k nearest fitted points
+        """
+        return self._nn.kneighbors(X, n_neighbors=k)
+
+
+class HNSWIndex:
+    """
+    Approximate k-nearest-neighbour search on a hierarchical navigable small world graph.
+    """
+
+    def __init__(self, m=16, ef_construction=200, ef=100, num_threads=-1):
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef = ef
+        self.num_threads = num_threads
+
+    def fit(self, X):
+        import hnswlib
+        X = np.asarray(X, dtype=np.float32)
+        self._index = hnswlib.Index(space='l2', dim=X.shape[1])
+        self._index.init_index(max_elements=len(X), ef_construction=self.ef_construction, M=self.m)
+        self._index.add_items(X, np.arange(len(X)), num_threads=self.num_threads)
+        return self
+
+    def query(self, X, k):
+        """
+        :param X: query vectors
+        :param k: number of neighbours
+        :return: euclidean distances and indices of the (approximately) k nearest fitted points
+        """
+        self._index.set_ef(max(self.ef, k))
+        indices, sq_distances = self._index.knn_query(np.asarray(X, dtype=np.float32), k=k,
+                                                      num_threads=self.num_threads)
+        return np.sqrt(np.maximum(sq_distances, 0)), indices.astype(np.int64)
+
+    def __getstate__(self):
+        # hnswlib indexes are saved through a file, keep the bytes so the fitted model pickles
+        state = self.__dict__.copy()
+        index = state.pop('_index', None)
+        if index is not None:
+            fd, path = tempfile.mkstemp(suffix='.hnsw')
+            os.close(fd)
+            try:
+                index.save_index(path)
+                with open(path, 'rb') as f:
+                    state['_index_bytes'] = f.read()
+                state['_index_shape'] = (index.get_current_count(), index.dim)
+            finally:
+                os.remove(path)
+        return state
+
+    def __setstate__(self, state):
+        index_bytes = state.pop('_index_bytes', None)
+        count, dim = state.pop('_index_shape', (0, 0))
+        self.__dict__.update(state)
+        if index_bytes is not None:
+            import hnswlib
+            fd, path = tempfile.mkstemp(suffix='.hnsw')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(index_bytes)
+                self._index = hnswlib.Index(space='l2', dim=dim)
+                self._index.load_index(path, max_elements=count)
+            finally:
+                os.remove(path)
+
+
+INDEXES = {'exact': ExactIndex, 'hnsw': HNSWIndex}
+
+
+class GraphLOF:
+    """
+    Local outlier factor computed from the neighbour graph of a pluggable index.
+    Follows the parts of sklearn's LocalOutlierFactor interface used in app.analysis.
+    """
+
+    def __init__(self, n_neighbors=20, novelty=False, index='hnsw'):
+        self.n_neighbors = n_neighbors
+        self.novelty = novelty
+        self.index = index
+        # sklearn's threshold for contamination='auto'
+        self.offset_ = -1.5
+
+    def _local_reachability_density(self, distances, indices):
+        reach_distances = np.maximum(distances, self._k_distance[indices])
+        return 1. / (np.mean(reach_distances, axis=1) + 1e-10)
+
+    def fit(self, X):
+        X = np.asarray(X, dtype=np.float32)
+        self.index_ = INDEXES[self.index]().fit(X)
+        self.n_neighbors_ = max(1, min(self.n_neighbors, len(X) - 1))
+
+        # query one extra neighbour and drop each point itself, or the farthest if the index missed it
+        distances, indices = self.index_.query(X, self.n_neighbors_ + 1)
+        drop = indices == np.arange(len(X))[:, None]
+        drop[~drop.any(axis=1), -1] = True
+        drop[np.cumsum(drop, axis=1) > 1] = False
+        keep = ~drop
+        distances = distances[keep].reshape(len(X), self.n_neighbors_)
+        indices = indices[keep].reshape(len(X), self.n_neighbors_)
+
+        self._k_distance = distances[:, -1]
+        self._lrd = self._local_reachability_density(distances, indices)
+        self.negative_outlier_factor_ = -np.mean(self._lrd[indices] / self._lrd[:, None], axis=1)
+        return self
+
+    def fit_predict(self, X):
+        """
+        :param X: training vectors
+        :return: -1 for outliers and 1 for inliers
+        """
+        self.fit(X)
+        return np.where(self.negative_outlier_factor_ < self.offset_, -1, 1)
+
+    def score_samples(self, X):
+        """
+        :param X: new vectors
+        :return: negative local outlier factor of each vector relative to the fitted data
+        """
+        distances, indices = self.index_.query(X, self.n_neighbors_)
+        lrd = self._local_reachability_density(distances, indices)
+        return -np.mean(self._lrd[indices] / lrd[:, None], axis=1)
+
+
+def make_lof(n_neighbors, novelty=False, backend=LOF_BACKEND):
+    """
+    :param n_neighbors: number of neighbours used for LOF
+    :param novelty: fit for scoring new data instead of the training data
+    :param backend: "exact" or an approximate index name from INDEXES
+    :return: unfitted LOF estimator
+    """
+    if backend == 'exact':
+        return LocalOutlierFactor(n_neighbors=n_neighbors, novelty=novelty, contamination='auto')
+    return GraphLOF(n_neighbors=n_neighbors, novelty=novelty, index=backend)
+
+
+def _fit_partition(shm_name, shape, dtype, start, stop, n_neighbors, backend):
+    """
+    Fits LOF on rows start:stop of a matrix in shared memory, so the vectors are not pickled per task.
+    :return: start, outlier labels and negative outlier factors of the rows
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    X = None
+    try:
+        X = np.ndarray(shape, dtype=dtype, buffer=shm.buf)[start:stop]
+        if len(X) < 3:
+            return start, np.ones(len(X), dtype=int), -np.ones(len(X))
+        lof = make_lof(n_neighbors=min(n_neighbors, len(X) - 1), backend=backend)
+        labels = lof.fit_predict(X)
+        return start, labels, lof.negative_outlier_factor_
+    finally:
+        # the view has to go before the segment can be closed
+        X = None
+        shm.close()
+
+
+def partitioned_lof(X, groups, n_neighbors=10, backend=LOF_BACKEND, workers=LOF_WORKERS):
+    """
+    Fits a separate LOF within each group, e.g. per FAQ, in a process pool.
+    n_neighbors is capped at the group size minus one, groups of fewer than 3 rows are never outliers.
+    :param X: vectors
+    :param groups: group label of each vector
+    :param n_neighbors: number of neighbours used for LOF
+    :param backend: "exact" or an approximate index name from INDEXES
+    :param workers: number of processes
+    :return: outlier labels (-1 for outliers) and negative outlier factors, in the order of X
+    """
+    X = np.asarray(X, dtype=np.float32)
+    # sort by group so each partition is a contiguous slice of one shared matrix
+    _, codes = np.unique(np.asarray(groups).astype(str), return_inverse=True)
+    order = np.argsort(codes, kind='mergesort')
+    bounds = np.flatnonzero(np.diff(np.r_[-1, codes[order], -1]))
+    partitions = sorted(zip(bounds[:-1], bounds[1:]), key=lambda b: b[0] - b[1])
+
+    shm = shared_memory.SharedMemory(create=True, size=max(X.nbytes, 1))
+    try:
+        shared = np.ndarray(X.shape, dtype=X.dtype, buffer=shm.buf)
+        shared[:] = X[order]
+        args = (shm.name, X.shape, X.dtype.str)
+        labels = np.ones(len(X), dtype=int)
+        scores = np.empty(len(X))
+        if workers <= 1 or len(partitions) <= 1:
+            fitted = [_fit_partition(*args, start, stop, n_neighbors, backend) for start, stop in partitions]
+        else:
+            # largest partitions first so the pool is not left waiting on one at the end
+            with ProcessPoolExecutor(max_workers=min(workers, len(partitions)),
+                                     mp_context=multiprocessing.get_context('spawn')) as pool:
+                futures = [pool.submit(_fit_partition, *args, start, stop, n_neighbors, backend)
+                           for start, stop in partitions]
+                fitted = [future.result() for future in futures]
+        for start, part_labels, part_scores in fitted:
+            rows = order[start:start + len(part_labels)]
+            labels[rows] = part_labels
+            scores[rows] = part_scores
+        del shared
+    finally:
+        shm.close()
+        shm.unlink()
+    return labels, scores
+
+
+def lof_recall_report(X, n_neighbors=10, backend='hnsw', queries=None):
+    """
+    :param X: training vectors
+    :param n_neighbors: number of neighbours used for LOF
+    :param backend: approximate index to compare against exact LOF
+    :param queries: optional new vectors to compare novelty scores on
+    :return: dict of neighbour recall, score agreement, outlier agreement and timings
+    """
+    X = np.asarray(X, dtype=np.float32)
+    report = {'rows': len(X), 'n_neighbors': n_neighbors, 'backend': backend}
+
+    start = time.perf_counter()
+    exact = LocalOutlierFactor(n_neighbors=n_neighbors, novelty=queries is not None, contamination='auto').fit(X)
+    report['exact_fit_s'] = time.perf_counter() - start
+    start = time.perf_counter()
+    approx = GraphLOF(n_neighbors=n_neighbors, index=backend).fit(X)
+    report['approx_fit_s'] = time.perf_counter() - start
+
+    _, exact_neighbors = exact.kneighbors()
+    _, approx_neighbors = approx.index_.query(X, n_neighbors + 1)
+    hits = [len(set(e) & set(a[a != i])) for i, (e, a) in enumerate(zip(exact_neighbors, approx_neighbors))]
+    report['knn_recall'] = float(np.sum(hits)) / exact_neighbors.size
+
+    exact_scores = exact.negative_outlier_factor_
+    approx_scores = approx.negative_outlier_factor_
+    report['score_spearman'] = float(spearmanr(exact_scores, approx_scores).correlation)
+    report['score_max_abs_diff'] = float(np.max(np.abs(exact_scores - approx_scores)))
+
+    exact_outliers = exact_scores < exact.offset_
+    approx_outliers = approx_scores < approx.offset_
+    both = np.sum(exact_outliers & approx_outliers)
+    report['outliers_exact'] = int(exact_outliers.sum())
+    report['outliers_approx'] = int(approx_outliers.sum())
+    report['outlier_precision'] = float(both / approx_outliers.sum()) if approx_outliers.any() else 1.0
+    report['outlier_recall'] = float(both / exact_outliers.sum()) if exact_outliers.any() else 1.0
+
+    if queries is not None:
+        start = time.perf_counter()
+        exact_novelty = exact.score_samples(queries)
+        report['exact_score_s'] = time.perf_counter() - start
+        start = time.perf_counter()
+        approx_novelty = approx.score_samples(queries)
+        report['approx_score_s'] = time.perf_counter() - start
+        report['novelty_spearman'] = float(spearmanr(exact_novelty, approx_novelty).correlation)
+    return report
@@ -0,0 +1,116 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import joblib
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from app.embedding import embed
+from app.metrics import LatencyTracker, span
+from app.neighbors import make_lof, LOF_BACKEND
+
+TRAIN_VECS_PATH = Path(os.getenv("TRAIN_VECS_PATH", "./data/extracted_n26_tsv_vecs.tsv"))
+MODEL_DIR = Path(os.getenv("MODEL_DIR", "models"))
+NOVELTY_NEIGHBORS = 20
+# "lof" scores against one global training set, "centroid" against per-FAQ centroids of each market's model,
+# see app.centroids
+NOVELTY_METHOD = os.getenv("NOVELTY_METHOD", "lof")
+
+_models = {}
+_models_lock = threading.Lock()
+
+
+def train_key(path=TRAIN_VECS_PATH):
+    """
+    :param path: training vectors TSV
+    :return: identifier that changes whenever the file is replaced
+    """
+    stat = Path(path).stat()
+    return "{}-{}-{}".format(Path(path).stem, stat.st_size, int(stat.st_mtime))
+
+
+def _save_atomic(path, save):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=str(path.parent), suffix=path.suffix)
+    os.close(fd)
+    save(tmp)
+    os.replace(tmp, str(path))
+
+
+def load_train_vectors(path=TRAIN_VECS_PATH):
+    """
+    :param path: training vectors TSV, first column is dropped
+    :return: read-only memory-mapped float32 matrix of the training vectors
+    """
+    npy_path = MODEL_DIR / "train" / (train_key(path) + ".npy")
+    if not npy_path.exists():
+        # one-off conversion, later runs map the binary copy
+        print("Converting " + str(path))
+        train_vecs = pd.read_csv(path, delimiter='\t|,', header=None, engine='python')
+        train_vecs = train_vecs.drop(train_vecs.columns[0], axis=1).values.astype(np.float32)
+        _save_atomic(npy_path, lambda tmp: np.save(tmp, train_vecs))
+    return np.load(str(npy_path), mmap_mode='r')
+
+
+def novelty_model_version(path=TRAIN_VECS_PATH, n_neighbors=NOVELTY_NEIGHBORS, backend=LOF_BACKEND):
+    """
+    :param path: training vectors TSV
+    :param n_neighbors: number of neighbours used for LOF
+    :param backend: neighbour backend for LOF
+    :return: version string identifying a fitted novelty model
+    """
+    return "lof-{}-k{}-{}".format(backend, n_neighbors, train_key(path))
+
+
+def get_novelty_model(path=TRAIN_VECS_PATH, n_neighbors=NOVELTY_NEIGHBORS, backend=LOF_BACKEND):
+    """
+    :param path: training vectors TSV
+    :param n_neighbors: number of neighbours used for LOF
+    :param backend: neighbour backend for LOF
+    :return: fitted novelty LOF, loaded from disk if this version was fitted before
+    """
+    version = novelty_model_version(path, n_neighbors, backend)
+    with _models_lock:
+        if version in _models:
+            return _models[version]
+        model_path = MODEL_DIR / "novelty" / version / "model.joblib"
+        if model_path.exists():
+            with span('novelty.load_model', version=version):
+                clf = joblib.load(str(model_path), mmap_mode='r')
+        else:
+            print("Fitting LOF...")
+            clf = make_lof(n_neighbors=n_neighbors, novelty=True, backend=backend)
+            with span('novelty.fit_lof', version=version) as s:
+                train_vecs = load_train_vectors(path)
+                s['rows'] = len(train_vecs)
+                clf.fit(train_vecs)
+            _save_atomic(model_path, lambda tmp: joblib.dump(clf, tmp))
+            with open(str(model_path.parent / "meta.json"), "w") as f:
+                json.dump({"version": version, "train_path": str(path), "n_neighbors": n_neighbors,
+                           "backend": backend, "created": time.strftime("%Y-%m-%dT%H:%M:%S")}, f)
+        _models[version] = clf
+        return clf
+
+
+scoring_latency = LatencyTracker()
+
+
+def score_utterances(texts, markets=None):
+    """
+    :param texts: list of new user utterances
+    :param markets: market of each utterance, used to pick the model if NOVELTY_METHOD is "centroid"
+    :return: novelty scores of the utterances against the persisted training neighbourhood
+    """
+    start = time.perf_counter()
+    with span('novelty.score_utterances') as s:
+        s['rows'] = len(texts)
+        if NOVELTY_METHOD == 'centroid':
+            # imported here as app.centroids builds on this module
+            from app.centroids import score_by_market
+            scores = score_by_market(texts, markets)['score'].values
+        else:
+            scores = get_novelty_model().score_samples(embed(texts))
+    scoring_latency.record(time.perf_counter() - start)
+    return scores
@@ -0,0 +1,128 @@
+import os
+import re
+import joblib
+import numpy as np
+import umap
+from sklearn.decomposition import IncrementalPCA
+from sklearn.preprocessing import StandardScaler
+from app.novelty import MODEL_DIR, _save_atomic
+
+REDUCER_DIR = MODEL_DIR / "reducers"
+# uploads with more rows than this are scaled in chunks and UMAP is fit on a sample
+LARGE_DATA_ROWS = int(os.getenv("LARGE_DATA_ROWS", 100000))
+UMAP_SAMPLE_SIZE = int(os.getenv("UMAP_SAMPLE_SIZE", 50000))
+REDUCE_CHUNK_SIZE = int(os.getenv("REDUCE_CHUNK_SIZE", 20000))
+
+
+def clean_bot_id(bot):
+    """
+    :param bot: bot id given by the user
+    :return: the id made safe for a file name, None if nothing is left
+    """
+    return re.sub(r'[^A-Za-z0-9_\-]', '_', bot or '').strip('_-') or None
+
+
+def bot_name(filename, bot=None):
+    """
+    :param filename: uploaded vector file, e.g. n26_vecs.npy
+    :param bot: bot id given by the user, takes precedence over the file name
+    :return: name of the bot the file belongs to, e.g. n26, None if it cannot be told from the name
+    """
+    if clean_bot_id(bot):
+        return clean_bot_id(bot)
+    # unrelated uploads must not share a reducer, so there is no fallback name
+    match = re.match(r'(.+?)[_\-.]?(?:vecs?|meta)\b', os.path.basename(filename))
+    return clean_bot_id(match.group(1)) if match else None
+
+
+def iter_chunks(n_rows, chunk_size=REDUCE_CHUNK_SIZE):
+    """
+    :param n_rows: number of rows to split
+    :param chunk_size: rows per chunk
+    :return: generator of slices covering the rows
+    """
+    for start in range(0, n_rows, chunk_size):
+        yield slice(start, min(start + chunk_size, n_rows))
+
+
+def fit_scaler(data, chunk_size=REDUCE_CHUNK_SIZE):
+    """
+    :param data: matrix of vector embeddings, may be memory-mapped
+    :param chunk_size: rows read at a time
+    :return: StandardScaler fit one chunk at a time
+    """
+    scaler = StandardScaler()
+    for rows in iter_chunks(len(data), chunk_size):
+        scaler.partial_fit(data[rows])
+    return scaler
+
+
+def transform_chunks(data, transformer, n_cols, chunk_size=REDUCE_CHUNK_SIZE):
+    """
+    :param data: matrix of vector embeddings, may be memory-mapped
+    :param transformer: fitted scaler, PCA or UMAP model
+    :param n_cols: number of output columns
+    :param chunk_size: rows transformed at a time
+    :return: float32 matrix of the transformed rows
+    """
+    out = np.empty((len(data), n_cols), dtype=np.float32)
+    for rows in iter_chunks(len(data), chunk_size):
+        out[rows] = transformer.transform(data[rows])
+    return out
+
+
+def fit_incremental_pca(scaled_data, n_comp, chunk_size=REDUCE_CHUNK_SIZE):
+    """
+    :param scaled_data: scaled vector embeddings
+    :param n_comp: number of components to reduce down to
+    :param chunk_size: rows read at a time, raised to n_comp if smaller
+    :return: IncrementalPCA fit one chunk at a time
+    """
+    # partial_fit needs at least n_comp rows, so split evenly rather than leave a short last chunk
+    n_chunks = max(1, len(scaled_data) // max(chunk_size, n_comp))
+    bounds = np.linspace(0, len(scaled_data), n_chunks + 1).astype(int)
+    pca = IncrementalPCA(n_components=n_comp)
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        pca.partial_fit(scaled_data[start:stop])
+    return pca
+
+
+def fit_umap(scaled_data, labels, sample_size=UMAP_SAMPLE_SIZE, seed=0):
+    """
+    :param scaled_data: scaled vector embeddings
+    :param labels: FAQ ids used to supervise the fit
+    :param sample_size: maximum number of rows the fit sees
+    :param seed: seed for the sample
+    :return: UMAP model fit on the sample, sampled row positions, their 2D embedding
+    """
+    reducer = umap.UMAP(n_components=2)
+    if len(scaled_data) > sample_size:
+        sample = np.sort(np.random.RandomState(seed).choice(len(scaled_data), sample_size, replace=False))
+    else:
+        sample = np.arange(len(scaled_data))
+    embedding = reducer.fit_transform(scaled_data[sample], y=np.asarray(labels)[sample])
+    return reducer, sample, embedding
+
+
+def reducer_path(bot):
+    return REDUCER_DIR / (bot + ".joblib")
+
+
+def load_reducer(bot, n_features):
+    """
+    :param bot: name of the bot, see bot_name
+    :param n_features: dimension of the uploaded vectors
+    :return: saved {'scaler', 'umap'} for the bot, or None if missing or fit on another dimension
+    """
+    path = reducer_path(bot)
+    if not path.exists():
+        return None
+    reducer = joblib.load(str(path))
+    if len(reducer['scaler'].mean_) != n_features:
+        print("Ignoring saved reducer for " + bot + ", fit on another dimension")
+        return None
+    return reducer
+
+
+def save_reducer(bot, scaler, reducer):
+    _save_atomic(reducer_path(bot), lambda tmp: joblib.dump({'scaler': scaler, 'umap': reducer}, tmp))
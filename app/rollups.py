@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+
+# aggregates are keyed by these columns, missing markets and intents are grouped under UNKNOWN
+CONFIDENCE_KEYS = ['market', 'intent', 'day']
+FEEDBACK_KEYS = ['market', 'dataset']
+UNKNOWN = 'unknown'
+
+
+def _fill_keys(df, keys):
+    return df.assign(**{key: df[key].astype(object).where(df[key].notnull(), UNKNOWN) for key in keys})
+
+
+def aggregate_confidence(messages):
+    """
+    :param messages: parsed user utterances from message_analytics
+    :return: count, sum and sum of squares of top intent confidence per market, intent and day
+    """
+    x = messages[messages['confidence'].notnull()]
+    confidence = x['confidence'].astype(np.float64)
+    df = pd.DataFrame({'market': x['market'].values,
+                       'intent': x['intent'].values,
+                       'day': pd.to_datetime(x['ts_in_db']).dt.floor('D').values,
+                       'count': np.ones(len(x), dtype=np.int64),
+                       'confidence_sum': confidence.values,
+                       'confidence_sumsq': (confidence ** 2).values})
+    df = _fill_keys(df, ['market', 'intent'])
+    return df.groupby(CONFIDENCE_KEYS, sort=False).sum().reset_index()
+
+
+def aggregate_feedback(novel):
+    """
+    :param novel: dataframe containing novelty scores of user feedback w/ metadata
+    :return: counts, novelty score sums and confidence sums per market and feedback type
+    """
+    confidence = pd.to_numeric(novel['confidence'], errors='coerce')
+    df = pd.DataFrame({'market': novel['market'].values,
+                       'dataset': novel['dataset'].values,
+                       'count': np.ones(len(novel), dtype=np.int64),
+                       'score_sum': novel['score'].astype(np.float64).values,
+                       'confidence_sum': confidence.fillna(0).values,
+                       'confidence_count': confidence.notnull().astype(np.int64).values})
+    df = _fill_keys(df, FEEDBACK_KEYS)
+    return df.groupby(FEEDBACK_KEYS, sort=False).sum().reset_index()
+
+
+def merge_rollup(rollup, delta, keys):
+    """
+    :param rollup: existing aggregates, or None
+    :param delta: aggregates of new rows
+    :param keys: columns the aggregates are keyed by
+    :return: combined aggregates
+    """
+    if rollup is None or rollup.empty:
+        return delta.reset_index(drop=True)
+    return pd.concat([rollup, delta], ignore_index=True).groupby(keys, sort=False).sum().reset_index()
+
+
+def _confidence_stats(grouped):
+    df = grouped[['count', 'confidence_sum', 'confidence_sumsq']].sum()
+    df = df[df['count'] > 0]
+    df['confidence'] = df['confidence_sum'] / df['count']
+    variance = (df['confidence_sumsq'] / df['count'] - df['confidence'] ** 2).clip(lower=0)
+    df['confidence std'] = np.sqrt(variance)
+    return df[['count', 'confidence', 'confidence std']]
+
+
+def confidence_by_period(rollup, freq, market=None):
+    """
+    :param rollup: confidence aggregates from aggregate_confidence
+    :param freq: pandas offset alias of the period, e.g. "1D" or "1W"
+    :param market: restrict to one market if given
+    :return: dataframe containing message count, mean and std of the top intent confidence per period
+    """
+    if market is not None:
+        rollup = rollup[rollup['market'] == market]
+    df = _confidence_stats(rollup.groupby(pd.Grouper(key='day', freq=freq)))
+    df['timestamp'] = df.index
+    return df
+
+
+def confidence_by_market(rollup):
+    """
+    :param rollup: confidence aggregates from aggregate_confidence
+    :return: dataframe containing message count, mean and std of the top intent confidence per market
+    """
+    return _confidence_stats(rollup.groupby('market')).reset_index()
+
+
+def market_summary(rollup):
+    """
+    :param rollup: feedback aggregates from aggregate_feedback
+    :return: dataframe containing various analytics for each market
+    """
+    counts = rollup.pivot_table(index='market', columns='dataset', values='count', aggfunc='sum', fill_value=0)
+    for dataset in ['positive feedback', 'negative feedback', 'something else']:
+        if dataset not in counts.columns:
+            counts[dataset] = 0
+    totals = rollup.groupby('market')[['count', 'score_sum', 'confidence_sum', 'confidence_count']].sum()
+    analysis_df = pd.DataFrame({
+        'market': totals.index,
+        'positive feedbacks': counts.loc[totals.index, 'positive feedback'].values,
+        'negative feedbacks': counts.loc[totals.index, 'negative feedback'].values,
+        'something else': counts.loc[totals.index, 'something else'].values,
+        'avg top intent confidence': (totals['confidence_sum'] /
+                                      totals['confidence_count'].where(totals['confidence_count'] > 0)).values,
+        'avg novelty score': (totals['score_sum'] / totals['count']).values,
+    })
+    return analysis_df.reset_index(drop=True)
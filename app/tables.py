@@ -0,0 +1,140 @@
+import json
+import threading
+from collections import OrderedDict
+import pandas as pd
+
+OPERATORS = [['ge ', '>='],
+             ['le ', '<='],
+             ['lt ', '<'],
+             ['gt ', '>'],
+             ['ne ', '!='],
+             ['eq ', '='],
+             ['contains '],
+             ['datestartswith ']]
+PAGE_SIZE = 50
+CSV_CHUNK_SIZE = 10000
+# number of table views whose filtered and sorted frame is kept
+QUERY_CACHE_SIZE = 8
+
+_query_cache = OrderedDict()
+_query_cache_lock = threading.Lock()
+
+
+def split_filter_part(filter_part):
+    """
+    :param filter_part: one "&&"-separated clause of a DataTable filter_query
+    :return: column name, operator and value of the clause
+    """
+    for operator_type in OPERATORS:
+        for operator in operator_type:
+            if operator in filter_part:
+                name_part, value_part = filter_part.split(operator, 1)
+                name = name_part[name_part.find('{') + 1: name_part.rfind('}')]
+                value_part = value_part.strip()
+                v0 = value_part[0] if value_part else ''
+                if v0 == value_part[-1:] and v0 in ("'", '"', '`'):
+                    value = value_part[1: -1].replace('\\' + v0, v0)
+                else:
+                    try:
+                        value = float(value_part)
+                    except ValueError:
+                        value = value_part
+                # word operators need spaces after them in the filter string, but we don't want these later
+                return name, operator_type[0].strip(), value
+    return [None] * 3
+
+
+def filter_frame(df, filter_query):
+    """
+    :param df: dataframe shown in a DataTable
+    :param filter_query: DataTable filter_query string
+    :return: rows of df matching the filter
+    """
+    if not filter_query:
+        return df
+    for filter_part in filter_query.split(' && '):
+        col_name, operator, filter_value = split_filter_part(filter_part)
+        if col_name not in df.columns:
+            continue
+        column = df[col_name]
+        if operator in ('eq', 'ne', 'lt', 'le', 'gt', 'ge'):
+            if isinstance(filter_value, float):
+                column = pd.to_numeric(column.astype(object), errors='coerce')
+            elif operator not in ('eq', 'ne'):
+                # categoricals and columns mixing numbers and strings cannot be ordered as they are
+                column = column.astype(object)
+                column = column.where(column.isna(), column.astype(str))
+                df = df.loc[column.notna() & getattr(column.fillna(''), operator)(filter_value)]
+                continue
+            df = df.loc[getattr(column, operator)(filter_value)]
+        elif operator == 'contains':
+            df = df.loc[column.astype(str).str.contains(str(filter_value), regex=False, na=False)]
+        elif operator == 'datestartswith':
+            df = df.loc[column.astype(str).str.startswith(str(filter_value), na=False)]
+    return df
+
+
+def sort_frame(df, sort_by):
+    """
+    :param df: dataframe shown in a DataTable
+    :param sort_by: DataTable sort_by list of {"column_id": ..., "direction": ...}
+    :return: df sorted by the given columns
+    """
+    sort_by = [col for col in (sort_by or []) if col['column_id'] in df.columns]
+    if not sort_by:
+        return df
+    keys = {}
+    for i, col in enumerate(sort_by):
+        column = df[col['column_id']].reset_index(drop=True)
+        # e.g. faq ids next to intent names, which cannot be compared with each other
+        if pd.api.types.infer_dtype(column, skipna=True).startswith('mixed'):
+            column = column.where(column.isna(), column.astype(str))
+        keys[i] = column
+    order = pd.DataFrame(keys).sort_values(list(keys), ascending=[col['direction'] == 'asc' for col in sort_by],
+                                           kind='mergesort').index
+    return df.iloc[order]
+
+
+def query_frame(name, df, filter_query, sort_by):
+    """
+    :param name: view the frame is shown in, one result is kept per view
+    :param df: dataframe shown in a DataTable
+    :param filter_query: DataTable filter_query string
+    :param sort_by: DataTable sort_by list
+    :return: filtered and sorted df, reused while the frame and query stay the same
+    """
+    query = (filter_query, json.dumps(sort_by, sort_keys=True))
+    with _query_cache_lock:
+        cached = _query_cache.get(name)
+    if cached is None or cached[0] is not df or cached[1] != query:
+        cached = (df, query, sort_frame(filter_frame(df, filter_query), sort_by))
+    # requests are served by several threads
+    with _query_cache_lock:
+        _query_cache[name] = cached
+        _query_cache.move_to_end(name)
+        while len(_query_cache) > QUERY_CACHE_SIZE:
+            _query_cache.popitem(last=False)
+    return cached[2]
+
+
+def page_records(df, page_current, page_size=PAGE_SIZE):
+    """
+    :param df: filtered and sorted dataframe
+    :param page_current: zero-based page index
+    :param page_size: rows per page
+    :return: records of the requested page
+    """
+    page_current = page_current or 0
+    page = df.iloc[page_current * page_size:(page_current + 1) * page_size]
+    return page.to_dict('records')
+
+
+def iter_csv(df, chunk_size=CSV_CHUNK_SIZE):
+    """
+    :param df: dataframe to export
+    :param chunk_size: rows serialised at a time
+    :return: generator of CSV text, header first
+    """
+    yield df.iloc[:0].to_csv(index=False)
+    for i in range(0, len(df), chunk_size):
+        yield df.iloc[i:i + chunk_size].to_csv(index=False, header=False)
@@ -0,0 +1,122 @@
+import io
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+from pathlib import Path
+from werkzeug.utils import secure_filename
+
+# large files can be streamed here with POST /api/upload/<filename> instead of the upload button
+UPLOAD_DIR = Path(os.getenv("UPLOAD_DIR", Path(os.getenv("CACHE_DIR", "cache")) / "uploads"))
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+
+def table_to_matrix(table):
+    """
+    :param table: arrow table with one float column per dimension, or a list column of vectors
+    :return: float32 matrix of the vectors, integer and text columns such as ids are ignored
+    """
+    for i, field in enumerate(table.schema):
+        if pa.types.is_fixed_size_list(field.type) or pa.types.is_list(field.type):
+            column = table.column(i)
+            values = pa.concat_arrays([chunk.flatten() for chunk in column.chunks]).to_numpy()
+            return values.astype(np.float32, copy=False).reshape(len(column), -1)
+    columns = [table.column(i).to_numpy() for i, field in enumerate(table.schema)
+               if pa.types.is_floating(field.type)]
+    return np.column_stack(columns).astype(np.float32, copy=False)
+
+
+def npy_from_bytes(data):
+    """
+    :param data: contents of a .npy file
+    :return: array viewing data without copying it, read-only
+    """
+    stream = io.BytesIO(data)
+    version = np.lib.format.read_magic(stream)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(stream)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(stream)
+    if dtype.hasobject:
+        raise ValueError("Pickled .npy files are not supported")
+    array = np.frombuffer(data, dtype=dtype, count=int(np.prod(shape)), offset=stream.tell())
+    return array.reshape(shape, order='F' if fortran_order else 'C')
+
+
+def vector_matrix(array):
+    """
+    :param array: vectors as stored in a .npy file
+    :return: float32 matrix of the vectors, the array itself if it already is one
+    """
+    if array.ndim != 2 or not (np.issubdtype(array.dtype, np.floating) or np.issubdtype(array.dtype, np.integer)):
+        raise ValueError("Expected a 2D numeric array of vectors, got " + str(array.dtype) + " " + str(array.shape))
+    return array.astype(np.float32, copy=False)
+
+
+def read_upload(source, filename, is_vec):
+    """
+    :param source: file path, or the uploaded bytes
+    :param filename: name of the uploaded file, its extension picks the parser
+    :param is_vec: true for the file of vector embeddings, false for the metadata
+    :return: float32 matrix of vector embeddings if is_vec, otherwise dataframe of metadata
+    """
+    name = filename.lower()
+    from_path = isinstance(source, (str, Path))
+    if not from_path:
+        # arrow readers work on the decoded buffer directly, without another copy
+        buffer = pa.py_buffer(source)
+    if name.endswith('.npy'):
+        if from_path:
+            # float32 files stay memory-mapped, other dtypes are converted once
+            return vector_matrix(np.load(str(source), mmap_mode='r'))
+        return vector_matrix(npy_from_bytes(source))
+    if name.endswith(('.parquet', '.arrow', '.feather')):
+        reader = pq.read_table if name.endswith('.parquet') else feather.read_table
+        table = reader(str(source) if from_path else pa.BufferReader(buffer))
+        return table_to_matrix(table) if is_vec else table.to_pandas()
+
+    if not from_path:
+        source = io.BytesIO(source)
+    if 'csv' in name:
+        df = pd.read_csv(source, header=None)
+    elif 'tsv' in name:
+        df = pd.read_csv(source, delimiter='\t', header=None)
+    elif 'xls' in name:
+        df = pd.read_excel(source, header=None)
+    else:
+        raise ValueError("Unsupported file type: " + filename)
+    if is_vec:
+        # first column holds the id of each vector
+        return df.drop(df.columns[0], axis=1).values.astype(np.float32)
+    df.columns = df.iloc[0]
+    return df[1:].reset_index(drop=True)
+
+
+def upload_path(filename):
+    """
+    :param filename: name of a file in the upload directory
+    :return: path of the file, restricted to the upload directory
+    """
+    return UPLOAD_DIR / secure_filename(filename)
+
+
+def save_stream(stream, filename):
+    """
+    :param stream: readable binary stream, e.g. the body of a chunked upload request
+    :param filename: name to save the file under
+    :return: path of the saved file
+    """
+    UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    path = upload_path(filename)
+    tmp = path.with_name(path.name + ".part")
+    with open(str(tmp), 'wb') as f:
+        while True:
+            chunk = stream.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            f.write(chunk)
+    os.replace(str(tmp), str(path))
+    return path
+
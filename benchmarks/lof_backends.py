@@ -0,0 +1,29 @@
+"""
+Compare exact LOF with LOF computed on an approximate neighbour graph.
+
+Run from the repository root:
+    python -m benchmarks.lof_backends --rows 20000 --dim 512 --backend hnsw
+"""
+import argparse
+
+from app.neighbors import lof_recall_report
+from benchmarks.synthetic import synthetic_embeddings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--dim', type=int, default=512)
+    parser.add_argument('--n-neighbors', type=int, default=20)
+    parser.add_argument('--backend', default='hnsw')
+    args = parser.parse_args()
+
+    X = synthetic_embeddings(args.rows + args.queries, args.dim)
+    report = lof_recall_report(X[:args.rows], args.n_neighbors, args.backend, queries=X[args.rows:])
+    for key, value in report.items():
+        print("{:<20} {}".format(key, value))
+
+
+if __name__ == '__main__':
+    main()
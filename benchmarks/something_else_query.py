@@ -0,0 +1,51 @@
+"""
+Compare the full-scan something else trigger lookup with the LAG window query, against the configured database.
+
+Run from the repository root:
+    python -m benchmarks.something_else_query
+"""
+import time
+
+import pandas as pd
+
+from app.database import concat_parsed, db_iter_message_analytics_raw, db_iter_something_else_triggers_raw, \
+    iter_parsed_message_analytics, SOMETHING_ELSE_INTENT
+
+
+def full_scan():
+    """
+    :return: rows transferred and the triggers found by taking the row before each press in table order
+    """
+    result = pd.concat(list(db_iter_message_analytics_raw()), ignore_index=True)
+    trigger_idx = result.index[result['top_intent'] == SOMETHING_ELSE_INTENT]
+    triggers = result.loc[trigger_idx[trigger_idx > 0] - 1]
+    return len(result), concat_parsed(iter_parsed_message_analytics([triggers.reset_index(drop=True)]))
+
+
+def window_query():
+    """
+    :return: rows transferred and the triggers found by the LAG window query
+    """
+    triggers = pd.concat(list(db_iter_something_else_triggers_raw()), ignore_index=True)
+    return len(triggers), concat_parsed(iter_parsed_message_analytics([triggers]))
+
+
+def main():
+    results = {}
+    for name, fn in [('full scan', full_scan), ('lag window', window_query)]:
+        start = time.perf_counter()
+        transferred, triggers = fn()
+        elapsed = time.perf_counter() - start
+        results[name] = triggers
+        print("{:<12} {:>8.2f} s {:>12} rows transferred {:>8} triggers".format(
+            name, elapsed, transferred, len(triggers)))
+
+    # triggers whose preceding row in table order belongs to another conversation
+    keys = ['conversation_id', 'ts_in_db']
+    merged = results['full scan'][keys].merge(results['lag window'][keys], how='left', indicator=True)
+    print("full-scan triggers not matching the conversation's previous turn: " +
+          str(int((merged['_merge'] == 'left_only').sum())))
+
+
+if __name__ == '__main__':
+    main()
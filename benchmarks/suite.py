@@ -0,0 +1,122 @@
+"""
+Time the data pipeline stages on synthetic data, without a database or the sentence encoder.
+Each stage runs inside an app.metrics span, so the report has the same fields as the /metrics endpoint.
+
+Run from the repository root:
+    python -m benchmarks.suite --scale 1 --out bench.json
+    python -m benchmarks.suite --baseline bench.json --tolerance 0.25
+
+With --baseline the run fails if any stage's median time is more than tolerance slower than in the baseline.
+"""
+import argparse
+import json
+import sys
+
+import numpy as np
+import pandas as pd
+
+import app.metrics
+from app.database import previous_turns, parse_message_analytics, split_feedback
+from app.events import decode_user_events
+from app.figures import downsample
+from app.metrics import registry, span
+from app.neighbors import make_lof, partitioned_lof
+from app.reduction import fit_scaler, fit_incremental_pca, transform_chunks
+from app.rollups import aggregate_confidence, aggregate_feedback, confidence_by_period, market_summary
+from app.tables import filter_frame, sort_frame
+from benchmarks.synthetic import synthetic_embeddings, synthetic_feedback, synthetic_messages, synthetic_upload
+
+
+def build_data(scale):
+    """
+    :param scale: multiplier of the default sizes
+    :return: dict of synthetic inputs
+    """
+    messages = synthetic_messages(int(100000 * scale))
+    feedback = synthetic_feedback(int(20000 * scale))
+    vecs, meta = synthetic_upload(int(10000 * scale), 512)
+    points = pd.DataFrame(synthetic_embeddings(int(200000 * scale), 2, seed=1), columns=['x', 'y'])
+    points['FAQ_id'] = np.random.RandomState(1).randint(0, 300, size=len(points))
+    return {'messages': messages, 'feedback': feedback, 'vecs': vecs, 'meta': meta, 'points': points}
+
+
+def stages(data):
+    """
+    :param data: inputs from build_data
+    :return: list of (name, rows, function) to time
+    """
+    parsed = parse_message_analytics(data['messages'], something_else=False)
+    rollup = aggregate_confidence(parsed)
+    pos, neg = split_feedback(data['feedback'])
+    novel = pos.assign(score=-1.0, dataset='pos', confidence=0.5).rename(columns={'utterance': 'text'})
+    scaled = transform_chunks(data['vecs'], fit_scaler(data['vecs']), data['vecs'].shape[1])
+    sort_by = [{'column_id': 'confidence', 'direction': 'desc'}]
+    return [
+        ('decode_user_events', len(data['messages']), lambda: decode_user_events(data['messages']['user_event'])),
+        ('previous_turns', len(data['messages']), lambda: previous_turns(data['messages'])),
+        ('parse_message_analytics', len(data['messages']),
+         lambda: parse_message_analytics(data['messages'], something_else=False)),
+        ('aggregate_confidence', len(parsed), lambda: aggregate_confidence(parsed)),
+        ('confidence_by_period', len(rollup), lambda: confidence_by_period(rollup, '1W')),
+        ('aggregate_feedback', len(novel), lambda: market_summary(aggregate_feedback(novel))),
+        ('fit_scaler', len(data['vecs']), lambda: fit_scaler(data['vecs'])),
+        ('incremental_pca', len(scaled), lambda: fit_incremental_pca(scaled, 50)),
+        ('lof_exact', len(scaled), lambda: make_lof(10, backend='exact').fit_predict(scaled)),
+        ('lof_hnsw', len(scaled), lambda: make_lof(10, backend='hnsw').fit_predict(scaled)),
+        ('lof_per_faq', len(scaled), lambda: partitioned_lof(scaled, data['meta']['FAQ_id'].values)),
+        ('downsample', len(data['points']), lambda: downsample(data['points'], max_points=len(data['points']) // 4)),
+        ('filter_sort', len(parsed), lambda: sort_frame(filter_frame(parsed, '{confidence} > 0.5'), sort_by)),
+    ]
+
+
+def compare(report, baseline, tolerance):
+    """
+    :return: stages whose median time grew by more than tolerance relative to the baseline
+    """
+    regressions = []
+    for name, stats in report.items():
+        before = baseline.get(name)
+        if before and before.get('p50_ms') and stats['p50_ms'] > before['p50_ms'] * (1 + tolerance):
+            regressions.append((name, before['p50_ms'], stats['p50_ms']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', type=float, default=1.)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', nargs='*', help='names of the stages to run')
+    parser.add_argument('--out', help='write the report to this JSON file')
+    parser.add_argument('--baseline', help='JSON report of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    # spans are aggregated for the report instead of logged
+    app.metrics.METRICS_LOG = ''
+    data = build_data(args.scale)
+    registry.reset()
+    for name, rows, fn in stages(data):
+        if args.only and name not in args.only:
+            continue
+        for _ in range(args.repeat):
+            with span('bench.' + name, rows=rows):
+                fn()
+        stats = registry.snapshot()['bench.' + name]
+        print("{:<24} {:>10} rows {:>10.1f} ms p50 {:>10.0f} rows/s {:>8.1f} MiB".format(
+            name, rows, stats['p50_ms'], rows / max(stats['p50_ms'] / 1000, 1e-9), stats['max_rss_delta_mb']))
+
+    report = {name[len('bench.'):]: stats for name, stats in registry.snapshot().items() if name.startswith('bench.')}
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for name, before, after in regressions:
+            print("REGRESSION {:<24} {:>10.1f} ms -> {:>10.1f} ms".format(name, before, after))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Synthetic data shaped like the production tables, shared by the benchmarks.
+"""
+import json
+
+import numpy as np
+import pandas as pd
+
+WORDS = ['card', 'transfer', 'account', 'blocked', 'limit', 'fee', 'app', 'login', 'pin', 'refund']
+MARKETS = ['de', 'fr', 'es', 'it', 'at', None]
+SOMETHING_ELSE_INTENT = 'navigational:something_else'
+
+
+def synthetic_text(rng, rows):
+    return [' '.join(rng.choice(WORDS, size=rng.randint(2, 12))) for _ in range(rows)]
+
+
+def synthetic_user_events(rows, seed=0):
+    """
+    :param rows: number of user_event strings to generate
+    :param seed: random seed
+    :return: series of user_event JSON strings shaped like message_analytics rows
+    """
+    rng = np.random.RandomState(seed)
+    events = []
+    for i in range(rows):
+        text = ' '.join(rng.choice(WORDS, size=rng.randint(2, 12)))
+        if i % 10 == 0:
+            top_intent = None
+        else:
+            top_intent = {'intent': 'faq:' + str(rng.randint(0, 300)), 'confidence': float(rng.rand())}
+        events.append(json.dumps({'text': text, 'top_intent': top_intent, 'lang': 'en'}))
+    return pd.Series(events)
+
+
+def synthetic_messages(rows, conversations=None, something_else_rate=0.02, seed=0):
+    """
+    :param rows: number of messages
+    :param conversations: number of conversations, defaults to one per 8 messages
+    :param something_else_rate: fraction of messages that are something else presses
+    :param seed: random seed
+    :return: raw message_analytics rows as returned by app.database.db_iter_message_analytics_raw
+    """
+    rng = np.random.RandomState(seed)
+    conversations = conversations or max(1, rows // 8)
+    top_intent = np.array(['faq:' + str(i) for i in rng.randint(0, 300, size=rows)], dtype=object)
+    top_intent[rng.rand(rows) < something_else_rate] = SOMETHING_ELSE_INTENT
+    return pd.DataFrame({
+        'ts_in_db': pd.Timestamp('2020-01-01') + pd.to_timedelta(np.sort(rng.randint(0, 90 * 86400, size=rows)),
+                                                                   unit='s'),
+        'top_intent': top_intent,
+        'user_event': synthetic_user_events(rows, seed).values,
+        'market': np.array(MARKETS, dtype=object)[rng.randint(0, len(MARKETS), size=rows)],
+        'conversation_id': ['c' + str(i) for i in rng.randint(0, conversations, size=rows)],
+    })
+
+
+def synthetic_feedback(rows, seed=0):
+    """
+    :param rows: number of feedback rows
+    :param seed: random seed
+    :return: raw faq_feedback_multilg rows as returned by app.database.db_get_faq_feedback_raw
+    """
+    rng = np.random.RandomState(seed)
+    return pd.DataFrame({
+        'id': np.arange(1, rows + 1),
+        'utterance': synthetic_text(rng, rows),
+        'correct': rng.choice([1, -1], size=rows, p=[0.7, 0.3]),
+        'faq_id': rng.randint(0, 300, size=rows),
+        'market': np.array(MARKETS[:-1], dtype=object)[rng.randint(0, len(MARKETS) - 1, size=rows)],
+    })
+
+
+def synthetic_embeddings(rows, dim, clusters=50, seed=0):
+    """
+    :param rows: number of vectors
+    :param dim: vector dimension
+    :param clusters: number of intent clusters
+    :param seed: random seed
+    :return: float32 matrix of clustered, unit-normalised vectors like sentence embeddings
+    """
+    rng = np.random.RandomState(seed)
+    centres = rng.randn(clusters, dim)
+    vecs = centres[rng.randint(0, clusters, size=rows)] + 0.6 * rng.randn(rows, dim)
+    return (vecs / np.linalg.norm(vecs, axis=1, keepdims=True)).astype(np.float32)
+
+
+def synthetic_upload(rows, dim, clusters=50, seed=0):
+    """
+    :param rows: number of training examples
+    :param dim: vector dimension
+    :param clusters: number of FAQs
+    :param seed: random seed
+    :return: vectors and metadata shaped like an uploaded bot, clustered by FAQ_id
+    """
+    rng = np.random.RandomState(seed)
+    labels = rng.randint(0, clusters, size=rows)
+    centres = rng.randn(clusters, dim)
+    vecs = centres[labels] + 0.6 * rng.randn(rows, dim)
+    vecs = (vecs / np.linalg.norm(vecs, axis=1, keepdims=True)).astype(np.float32)
+    meta = pd.DataFrame({'question': synthetic_text(rng, rows), 'FAQ_id': labels})
+    return vecs, meta
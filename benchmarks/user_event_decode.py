@@ -0,0 +1,53 @@
+"""
+Compare the legacy literal_eval/eval parsing of user_event with app.events.decode_user_events.
+
+Run from the repository root:
+    python -m benchmarks.user_event_decode --rows 200000
+"""
+import argparse
+import time
+import tracemalloc
+from ast import literal_eval
+
+import pandas as pd
+
+from app.events import decode_user_events
+from benchmarks.synthetic import synthetic_user_events
+
+
+def legacy_decode(user_events):
+    """
+    :param user_events: series of user_event JSON strings
+    :return: the frame produced by the original db_get_message_analytics parsing
+    """
+    user_event_list = user_events.to_list()
+    user_event_list = str(user_event_list).replace("null", "123456")
+    parsed = pd.Series(literal_eval(user_event_list))
+    text = parsed.map(eval)
+    return text.apply(pd.Series)
+
+
+def measure(fn, user_events):
+    tracemalloc.start()
+    start = time.perf_counter()
+    fn(user_events)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000)
+    args = parser.parse_args()
+
+    user_events = synthetic_user_events(args.rows)
+    for name, fn in [('legacy eval', legacy_decode), ('json decode', decode_user_events)]:
+        elapsed, peak = measure(fn, user_events)
+        print("{:<12} {:>8.2f} s {:>10.0f} rows/s {:>8.1f} MiB peak".format(
+            name, elapsed, args.rows / elapsed, peak))
+
+
+if __name__ == '__main__':
+    main()
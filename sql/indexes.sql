@@ -0,0 +1,16 @@
+-- Recommended indexes for the queries in app/database.py (MySQL 8.0+, which is also needed for LAG).
+
+-- Conversations containing a something else press: an index-only lookup for the IN subquery
+-- of db_iter_something_else_triggers_raw. If top_intent is a TEXT column, index a prefix,
+-- e.g. top_intent(64).
+CREATE INDEX idx_message_analytics_intent_conversation
+    ON message_analytics (top_intent, conversation_id);
+
+-- Rows of those conversations already in (conversation_id, ts_in_db) order, so the
+-- LAG window needs no filesort.
+CREATE INDEX idx_message_analytics_conversation_ts
+    ON message_analytics (conversation_id, ts_in_db);
+
+-- Range scans above the local cache's high-water mark in db_iter_message_analytics_raw.
+CREATE INDEX idx_message_analytics_ts
+    ON message_analytics (ts_in_db);
@@ -0,0 +1,127 @@
+import json
+import sqlite3
+
+import pandas as pd
+import pytest
+
+from app import cache, database
+
+SOMETHING_ELSE = database.SOMETHING_ELSE_INTENT
+
+
+def user_event(text, intent='faq:1', confidence=0.5):
+    return json.dumps({'text': text, 'top_intent': {'intent': intent, 'confidence': confidence}})
+
+
+MESSAGES = [
+    # ts_in_db, top_intent, user_event, market_id, conversation_id
+    ('2020-01-01 10:00:00', 'faq:1', user_event('card blocked'), 1, 'c1'),
+    ('2020-01-01 10:01:00', SOMETHING_ELSE, user_event('something else'), 1, 'c1'),
+    ('2020-01-01 10:02:00', 'faq:2', user_event('transfer limit'), 2, 'c2'),
+    ('2020-01-02 09:00:00', SOMETHING_ELSE, user_event('something else'), 2, 'c3'),
+    ('2020-01-02 09:05:00', 'faq:3', user_event('new pin'), None, 'c4'),
+    ('2020-01-02 09:06:00', SOMETHING_ELSE, user_event('something else'), None, 'c4'),
+    ('2020-01-02 09:06:00', 'faq:4', user_event('refund'), 1, 'c5'),
+]
+
+
+@pytest.fixture
+def sqlite_db(tmp_path, monkeypatch):
+    path = tmp_path / 'analytics.sqlite'
+    conn = sqlite3.connect(str(path))
+    conn.executescript("""
+        CREATE TABLE markets (market_id INTEGER, market TEXT);
+        CREATE TABLE faq_feedback_multilg (id INTEGER, utterance TEXT, correct INTEGER, faq_id INTEGER,
+                                           market_id INTEGER);
+        CREATE TABLE message_analytics (ts_in_db TEXT, top_intent TEXT, user_event TEXT, market_id INTEGER,
+                                        conversation_id TEXT);
+        INSERT INTO markets VALUES (1, 'de'), (2, 'fr');
+        INSERT INTO faq_feedback_multilg VALUES (1, 'hi', 1, 3, 1), (2, 'bye', -1, 4, 2);
+    """)
+    conn.executemany("INSERT INTO message_analytics VALUES (?, ?, ?, ?, ?)", MESSAGES)
+    conn.commit()
+    monkeypatch.setattr(database, 'DB_BACKEND', 'sqlite')
+    monkeypatch.setattr(database, 'DB_SQLITE_PATH', str(path))
+    monkeypatch.setattr(database, 'DB_RETRY_DELAY', 0)
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    root = tmp_path / 'cache'
+    monkeypatch.setattr(cache, 'CACHE_DIR', root)
+    monkeypatch.setattr(cache, 'MESSAGES_DIR', root / 'message_analytics')
+    monkeypatch.setattr(cache, 'FEEDBACK_DIR', root / 'faq_feedback_multilg')
+    monkeypatch.setattr(cache, 'WATERMARKS', root / 'watermarks.json')
+    monkeypatch.setattr(cache, 'INTENT_ROLLUP', root / 'rollups' / 'intent_daily.parquet')
+    return root
+
+
+def flaky_connect(monkeypatch, failures, error):
+    calls = []
+    connect = database._connect
+
+    def _connect():
+        calls.append(1)
+        if len(calls) <= failures:
+            raise error
+        return connect()
+    monkeypatch.setattr(database, '_connect', _connect)
+    return calls
+
+
+def test_query_retries_transient_errors(sqlite_db, monkeypatch):
+    calls = flaky_connect(monkeypatch, 2, sqlite3.OperationalError('database is locked'))
+    result = database.db_get_faq_feedback_raw()
+    assert len(result) == 2
+    assert len(calls) == 3
+
+
+def test_query_gives_up_after_retries(sqlite_db, monkeypatch):
+    calls = flaky_connect(monkeypatch, 10, sqlite3.OperationalError('database is locked'))
+    with pytest.raises(sqlite3.OperationalError):
+        database.db_get_faq_feedback_raw()
+    assert len(calls) == database.DB_RETRIES + 1
+
+
+def test_query_does_not_retry_missing_table(sqlite_db, monkeypatch):
+    calls = flaky_connect(monkeypatch, 0, None)
+    with pytest.raises(sqlite3.OperationalError, match='no such table'):
+        database._query('missing', "SELECT * FROM missing")
+    assert len(calls) == 1
+
+
+def test_stream_retries_before_yielding(sqlite_db, monkeypatch):
+    calls = flaky_connect(monkeypatch, 2, sqlite3.OperationalError('database is busy'))
+    chunks = list(database.db_iter_message_analytics_raw(chunk_size=3))
+    assert [len(chunk) for chunk in chunks] == [3, 3, 1]
+    assert len(calls) == 3
+    assert list(pd.concat(chunks)['ts_in_db']) == sorted(row[0] for row in MESSAGES)
+
+
+def test_trigger_query_matches_previous_turns(sqlite_db):
+    raw = pd.concat(list(database.db_iter_message_analytics_raw()), ignore_index=True)
+    expected = database.previous_turns(raw)
+    triggers = pd.concat(list(database.db_iter_something_else_triggers_raw()), ignore_index=True)
+
+    def rows(df):
+        return sorted(zip(df['conversation_id'], df['ts_in_db'], df['user_event'], df['market'].fillna('')))
+    assert rows(triggers) == rows(expected)
+    assert len(triggers) == 2
+
+
+def test_sync_skips_rows_already_cached_at_the_watermark(sqlite_db, cache_dir):
+    assert cache.sync_message_analytics(chunk_size=2) == len(MESSAGES)
+    assert cache.sync_message_analytics(chunk_size=2) == 0
+
+    # arrives later with the same timestamp as the newest cached rows
+    late = ('2020-01-02 09:06:00', 'faq:5', user_event('late'), 2, 'c6')
+    sqlite_db.execute("INSERT INTO message_analytics VALUES (?, ?, ?, ?, ?)", late)
+    sqlite_db.commit()
+    assert cache.sync_message_analytics(chunk_size=2) == 1
+    assert cache.sync_message_analytics(chunk_size=2) == 0
+
+    messages = cache.cached_message_analytics(something_else=False, sync=False)
+    assert len(messages) == len(MESSAGES) + 1
+    assert cache.cached_intent_rollup(sync=False)['count'].sum() == len(MESSAGES) + 1